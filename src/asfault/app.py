@@ -19,7 +19,7 @@ import seaborn as sns
 import scipy
 import scipy.stats
 
-from asfault import config, experiments
+from asfault import benchmarks, config, experiments
 from asfault.beamer import *
 from asfault.network import *
 from asfault.evolver import *
@@ -220,6 +220,56 @@ def run_test(test_file):
     execution = runner.run()
 
 
+@cli.group()
+@click.option('--env', type=click.Path(file_okay=False), default=DEFAULT_ENV)
+def benchmark(env):
+    ensure_environment(env)
+
+
+@benchmark.command()
+@click.option('--sizes', default='50,100,250,500,1000,2000')
+@click.option('--queries', default=1000)
+@click.option('--seed', default=0)
+def spindex(sizes, queries, seed):
+    sizes = [int(size) for size in sizes.split(',')]
+    results = benchmarks.benchmark_spindex(sizes, queries, seed=seed)
+    click.echo('{:<10} {:>6} {:>8} {:>12} {:>12} {:>12}'.format(
+        'Index', 'Size', 'Indexed', 'Build (us)', 'Box (us)', 'Point (us)'))
+    for result in results:
+        click.echo('{:<10} {:>6} {:>8} {:>12.1f} {:>12.2f} {:>12.2f}'.format(
+            result['kind'], result['size'], result['indexed'],
+            result['build'], result['box_query'], result['point_query']))
+
+
+@benchmark.command()
+@click.option('--sizes', default='50,100,250,500,1000,2000')
+@click.option('--copies', default=10)
+@click.option('--seed', default=0)
+def nodes(sizes, copies, seed):
+    sizes = [int(size) for size in sizes.split(',')]
+    results = benchmarks.benchmark_nodes(sizes, copies, seed=seed)
+    click.echo('{:>6} {:>16} {:>10}'.format('Size', 'Memory (B/seg)',
+                                            'Copy (ms)'))
+    for result in results:
+        click.echo('{:>6} {:>16.0f} {:>10.2f}'.format(
+            result['size'], result['memory'], result['copy']))
+
+
+@benchmark.command()
+@click.option('--sizes', default='50,100,250,500,1000,2000')
+@click.option('--copies', default=10)
+@click.option('--seed', default=0)
+def parentage(sizes, copies, seed):
+    sizes = [int(size) for size in sizes.split(',')]
+    results = benchmarks.benchmark_parentage(sizes, copies, seed=seed)
+    click.echo('{:<10} {:>6} {:>16} {:>10} {:>16}'.format(
+        'Structure', 'Size', 'Memory (B/seg)', 'Copy (ms)', 'Traversal (ms)'))
+    for result in results:
+        click.echo('{:<10} {:>6} {:>16.0f} {:>10.2f} {:>16.2f}'.format(
+            result['structure'], result['size'], result['memory'],
+            result['copy'], result['traversal']))
+
+
 def process_oob_segs(oob_segs):
     summary = defaultdict(int)
     for seg_key, count in oob_segs.items():
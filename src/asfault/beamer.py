@@ -109,18 +109,18 @@ def get_car_direction(test):
 
 
 def get_node_segment_coords(node, coord, idx):
-    line = node.get_line(idx)
-    coords = {'x': coord[0], 'y': coord[1], 'z': 0.01, 'width': line.length}
+    width = float(node.get_widths()[idx])
+    coords = {'x': coord[0], 'y': coord[1], 'z': 0.01, 'width': width}
     return coords
 
 
 def get_node_coords(node, last_coords=None, sealed=True):
     ret = []
     spine = node.get_spine()
+    widths = node.get_widths().tolist()
     for idx, coord in enumerate(spine.coords):
-        line = node.get_line(idx)
         coords_dict = {'x': coord[0], 'y': coord[1],
-                       'z': 0.01, 'width': line.length}
+                       'z': 0.01, 'width': widths[idx]}
         if last_coords:
             point_last = Point(last_coords['x'], last_coords['y'])
             point_current = Point(coords_dict['x'], coords_dict['y'])
@@ -171,10 +171,8 @@ def get_street_nodes(network, root):
         cursor_spine = cursor.get_spine()
         cursor_coords = cursor_spine.coords
         cursor_coords = cursor_coords[:-1]
-        for idx, coord in enumerate(cursor_coords):
-            coords.append(coord)
-            line = cursor.get_line(idx)
-            widths.append(line.length)
+        coords.extend(cursor_coords)
+        widths.extend(cursor.get_widths()[:-1].tolist())
         last_cursor = cursor
         cursor = network.get_children(cursor)
 
@@ -183,8 +181,7 @@ def get_street_nodes(network, root):
     cursor_spine = last_cursor.get_spine()
     cursor_coords = cursor_spine.coords
     coords.append(cursor_coords[-1])
-    line = last_cursor.get_front_line()
-    widths.append(line.length)
+    widths.append(float(last_cursor.get_widths()[-1]))
 
     line = LineString(coords)
     nodes = polyline_to_decalroad(line, widths)
@@ -236,18 +233,17 @@ def get_intersection_dividers(cursor_spine, intersection):
     # Split spine at both l_ and r_inter and see which one is shorter to find out
     # whether we need to cut off the spine at the left or right edge of the
     # intersecting road segment
-    l_split_beg, _ = split(cursor_spine, l_inter)
-    r_split_beg, _ = split(cursor_spine, r_inter)
+    l_split, r_split = split_many(cursor_spine, (l_inter, r_inter))
+    l_split_beg, l_split_end = l_split
+    r_split_beg, r_split_end = r_split
 
     if l_split_beg.length < r_split_beg.length:
         # l_inter is the clipping point for the shared area of the intersection
-        # Split spine at r_inter to get rest of divider
-        _, r_split_end = split(cursor_spine, r_inter)
+        # Use the spine after r_inter as the rest of divider
         return l_split_beg, r_split_end
     else:
         # r_inter is the clipping point for the shared area of the intersection
-        # Split spine at l_inter to get rest of divider
-        _, l_split_end = split(cursor_spine, l_inter)
+        # Use the spine after l_inter as the rest of divider
         return r_split_beg, l_split_end
 
 
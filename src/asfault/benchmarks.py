@@ -0,0 +1,205 @@
+import logging as l
+import random
+import tracemalloc
+
+from time import perf_counter
+
+from networkx.algorithms.shortest_paths import shortest_path
+from shapely.geometry import box
+
+from asfault import config as c
+from asfault.generator import dummy_lanes
+from asfault.network import *
+from asfault.spatial import INDICES, create_index
+
+DEFAULT_SIZES = (50, 100, 250, 500, 1000, 2000)
+BRANCH_LENGTH = 25
+
+
+def random_layout(rng, size, bounds_size=None):
+    """
+    Builds a network of the given number of segments by growing random
+    chains of segment factories from roots scattered over the map. The
+    result is not meant to be consistent, it just provides realistic
+    segment geometry to benchmark against.
+    """
+    if not bounds_size:
+        bounds_size = c.ev.bounds
+    bounds = box(-bounds_size, -bounds_size, bounds_size, bounds_size)
+    network = NetworkLayout(bounds)
+    factories = sorted(SEG_FACTORIES.keys())
+
+    count = 0
+    while count < size:
+        options = {'x': rng.uniform(-bounds_size, bounds_size),
+                   'y': rng.uniform(-bounds_size, bounds_size),
+                   'angle': rng.uniform(0, 360)}
+        root = NetworkNode(network.next_seg_id(), TYPE_ROOT, TYPE_ROOT,
+                           **options)
+        root.l_lanes = dummy_lanes(1, c.ev.l_lanes)
+        root.r_lanes = dummy_lanes(c.ev.l_lanes + 1, c.ev.r_lanes)
+        network.add_node(root)
+
+        parent = root
+        for _ in range(min(BRANCH_LENGTH, size - count)):
+            factory = SEG_FACTORIES[rng.choice(factories)]
+            child = factory(network.next_seg_id(), parent)[0]
+            network.add_parentage(parent, child)
+            parent = child
+            count += 1
+
+    network.update_abs()
+    return network
+
+
+def time_call(func, repeat):
+    beg = perf_counter()
+    for _ in range(repeat):
+        func()
+    return (perf_counter() - beg) / repeat
+
+
+def benchmark_spindex(sizes=DEFAULT_SIZES, queries=1000, repeat=5, seed=0):
+    """
+    Measures bulk build time and query time of every spatial index backend
+    on random networks of the given sizes. Queries use the bounding boxes of
+    segment polygons, as get_intersecting_nodes does, and points, as
+    get_nodes_at does. Returns one dictionary of timings per size and
+    backend, with times given in microseconds.
+    """
+    rng = random.Random(seed)
+    ret = []
+    for size in sizes:
+        network = random_layout(rng, size)
+        entries = list(network.spindex_boxes.items())
+        bounds = network.bounds.bounds
+
+        boxes = [bbox for _, bbox in entries]
+        boxes = [rng.choice(boxes) for _ in range(queries)]
+        points = []
+        for _ in range(queries):
+            x = rng.uniform(bounds[0], bounds[2])
+            y = rng.uniform(bounds[1], bounds[3])
+            points.append((x, y, x, y))
+
+        for kind in sorted(INDICES.keys()):
+            l.info('Benchmarking %s index with %s segments.', kind, size)
+            build = time_call(lambda: create_index(bounds, entries, kind=kind),
+                              repeat)
+            index = create_index(bounds, entries, kind=kind)
+
+            def query_all(bboxes):
+                for bbox in bboxes:
+                    index.intersect(bbox)
+
+            box_query = time_call(lambda: query_all(boxes), repeat)
+            point_query = time_call(lambda: query_all(points), repeat)
+
+            ret.append({'kind': kind,
+                        'size': size,
+                        'indexed': len(entries),
+                        'build': build * 1e6,
+                        'box_query': box_query / queries * 1e6,
+                        'point_query': point_query / queries * 1e6})
+
+    return ret
+
+
+def benchmark_nodes(sizes=DEFAULT_SIZES, copies=10, repeat=5, seed=0):
+    """
+    Measures the memory held by copies of random networks of the given sizes
+    and the time it takes to copy them. Memory is what tracemalloc sees, so
+    Python objects and NumPy buffers, but not the GEOS geometries behind
+    shapely objects. Returns one dictionary per size with the memory per
+    segment in bytes and the copy time in milliseconds.
+    """
+    rng = random.Random(seed)
+    ret = []
+    for size in sizes:
+        network = random_layout(rng, size)
+        # Networks in a population have been checked for intersections
+        network.check_reachable_intersections()
+        l.info('Benchmarking copies of network with %s segments.', size)
+
+        tracemalloc.start()
+        beg = tracemalloc.get_traced_memory()[0]
+        kept = [network.copy() for _ in range(copies)]
+        end = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del kept
+
+        copy = time_call(network.copy, repeat)
+        ret.append({'size': size,
+                    'memory': (end - beg) / (copies * size),
+                    'copy': copy * 1e3})
+
+    return ret
+
+
+def walk_graph(graph, roots, nodes):
+    # What getting branches, roots and paths from the root took when the
+    # parentage was a networkx graph
+    for root in roots:
+        branch = [root]
+        while True:
+            children = list(graph.successors(branch[-1]))
+            if len(children) != 1:
+                break
+            branch.append(children[0])
+
+    for node in nodes:
+        root = node
+        while True:
+            parents = list(graph.predecessors(root))
+            if not parents:
+                break
+            root = parents[0]
+        shortest_path(graph, root, node)
+
+
+def walk_parentage(parentage, roots, nodes):
+    for root in roots:
+        parentage.get_branch_from(root)
+
+    for node in nodes:
+        parentage.get_root(node)
+        parentage.get_path_to(node)
+
+
+def benchmark_parentage(sizes=DEFAULT_SIZES, copies=10, repeat=5, seed=0):
+    """
+    Compares the chain based parentage structure of networks against the
+    networkx graph it replaced on random networks of the given sizes. Copy
+    time and the memory held by copies are measured along with traversal,
+    which gets the branch of every root and the root and path from the root
+    of every segment. Returns one dictionary per size and structure with the
+    memory per segment in bytes and times in milliseconds.
+    """
+    rng = random.Random(seed)
+    ret = []
+    for size in sizes:
+        network = random_layout(rng, size)
+        structures = (('networkx', network.parentage.to_networkx(), walk_graph),
+                      ('chains', network.parentage, walk_parentage))
+        roots = network.get_roots()
+        nodes = list(network.parentage.nodes())
+
+        for name, structure, walk in structures:
+            l.info('Benchmarking %s parentage with %s segments.', name, size)
+            tracemalloc.start()
+            beg = tracemalloc.get_traced_memory()[0]
+            kept = [structure.copy() for _ in range(copies)]
+            end = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del kept
+
+            copy = time_call(structure.copy, repeat)
+            traversal = time_call(lambda: walk(structure, roots, nodes),
+                                  repeat)
+            ret.append({'structure': name,
+                        'size': size,
+                        'memory': (end - beg) / (copies * size),
+                        'copy': copy * 1e3,
+                        'traversal': traversal * 1e3})
+
+    return ret
@@ -9,6 +9,7 @@ PATH_PLOTS = 'plots'
 PATH_GRAPHS = 'graphs'
 PATH_TESTS = 'tests'
 PATH_EXECS = 'execs'
+PATH_POOL = 'pool'
 FILE_EVOLUTION = 'evolution.json'
 FILE_EXECUTION = 'execution.json'
 FILE_PLOT = 'plot.json'
@@ -82,6 +83,10 @@ class AsFaultEnv:
         execs_path = self.get_output_path()
         return os.path.join(execs_path, PATH_EXECS)
 
+    def get_pool_path(self):
+        output_path = self.get_output_path()
+        return os.path.join(output_path, PATH_POOL)
+
     def ensure_directories(self):
         paths = [
             self.env_dir,
@@ -112,6 +117,17 @@ class EvolutionConfig:
     PARTIAL_MERGE_M_COUNT = 1
     PARTIAL_MERGE_D_COUNT = 1
     TRY_ALL_OPS = True
+    # One of 'quadtree', 'rtree' or 'grid'. In benchmark_spindex runs with
+    # 50 to 2000 segments the grid answered box queries 5 to 40% and point
+    # queries 2 to 5 times faster than the quadtree, while the packed R-tree
+    # only builds faster.
+    SPATIAL_INDEX = 'quadtree'
+    PATH_CANDIDATES = 5
+    PATH_SEARCH_BUDGET = 256
+    GENERATION_WORKERS = 1
+    GENERATION_RESTARTS = 'none'
+    GENERATION_STEP_BUDGET = 500
+    LAYOUT_POOL_SIZE = 0
 
     @staticmethod
     def get_default():
@@ -132,6 +148,13 @@ class EvolutionConfig:
         ret['partial_merge_m_count'] = EvolutionConfig.PARTIAL_MERGE_M_COUNT
         ret['partial_merge_d_count'] = EvolutionConfig.PARTIAL_MERGE_D_COUNT
         ret['try_all_ops'] = EvolutionConfig.TRY_ALL_OPS
+        ret['spatial_index'] = EvolutionConfig.SPATIAL_INDEX
+        ret['path_candidates'] = EvolutionConfig.PATH_CANDIDATES
+        ret['path_search_budget'] = EvolutionConfig.PATH_SEARCH_BUDGET
+        ret['generation_workers'] = EvolutionConfig.GENERATION_WORKERS
+        ret['generation_restarts'] = EvolutionConfig.GENERATION_RESTARTS
+        ret['generation_step_budget'] = EvolutionConfig.GENERATION_STEP_BUDGET
+        ret['layout_pool_size'] = EvolutionConfig.LAYOUT_POOL_SIZE
 
         return ret
 
@@ -154,6 +177,13 @@ class EvolutionConfig:
         self.partial_merge_m_count = cfg.get('partial_merge_m_count', EvolutionConfig.PARTIAL_MERGE_M_COUNT)
         self.partial_merge_d_count = cfg.get('partial_merge_d_count', EvolutionConfig.PARTIAL_MERGE_D_COUNT)
         self.try_all_ops = cfg.get('try_all_ops', EvolutionConfig.TRY_ALL_OPS)
+        self.spatial_index = cfg.get('spatial_index', EvolutionConfig.SPATIAL_INDEX)
+        self.path_candidates = cfg.get('path_candidates', EvolutionConfig.PATH_CANDIDATES)
+        self.path_search_budget = cfg.get('path_search_budget', EvolutionConfig.PATH_SEARCH_BUDGET)
+        self.generation_workers = cfg.get('generation_workers', EvolutionConfig.GENERATION_WORKERS)
+        self.generation_restarts = cfg.get('generation_restarts', EvolutionConfig.GENERATION_RESTARTS)
+        self.generation_step_budget = cfg.get('generation_step_budget', EvolutionConfig.GENERATION_STEP_BUDGET)
+        self.layout_pool_size = cfg.get('layout_pool_size', EvolutionConfig.LAYOUT_POOL_SIZE)
 
 
 class PlotConfig:
@@ -1,5 +1,8 @@
+import copy
 import datetime
+import json
 import logging as l
+import multiprocessing
 import random
 import sys
 
@@ -11,12 +14,19 @@ from asfault import crossovers
 from asfault import mutations
 from asfault.config import *
 from asfault.beamer import TestRunner, RESULT_SUCCESS, REASON_OFF_TRACK, REASON_TIMED_OUT, REASON_GOAL_REACHED, generate_test_prefab
-from asfault.generator import RoadGenerator, generate_networks
+from asfault.generator import RoadGenerator, GenerationPool, \
+    generate_networks
 from asfault.tests import *
 from asfault.plotter import *
-from asfault.network import SEG_FACTORIES
+from asfault.network import SEG_FACTORIES, GHOST_TYPES, LayoutMemo, \
+    CONSISTENCY_STATS, CONSISTENCY_VERDICTS
+from asfault.pool import LayoutPool, get_pool_path
 
 UNIQUE_THRESHOLD = 0.1
+# Seconds the pool worker waits before checking a full pool again
+POOL_POLL_INTERVAL = 1.0
+# Seconds between checks for an entry the pool worker is growing
+POOL_WAIT_INTERVAL = 0.05
 
 def plot_test(plot_file, test):
     title = 'Test: {}'.format(test.test_id)
@@ -64,23 +74,50 @@ def score_path_polyline(path_line):
 
 
 class PathEstimator:
-    def score_path(self, polyline):
+    def score_path(self, path, polyline):
         raise NotImplementedError()
 
+    def weigh_node(self, node):
+        """
+        Cheap estimate of what the given segment contributes to the score of
+        a path running through it. Path search uses it to pick the paths
+        worth computing polylines for.
+        """
+        return 1
+
+    def find_paths(self, network, start, goal):
+        """
+        Returns the paths from start to goal in the given network worth
+        computing polylines and scores for.
+        """
+        return network.best_paths(start, goal, self.weigh_node)
+
 
-class RandomPathEstimator:
+class RandomPathEstimator(PathEstimator):
     def __init__(self, rng):
         self.rng = rng
 
     def score_path(self, path, polyline):
         return self.rng.uniform(0, 10)
 
+    def find_paths(self, network, start, goal):
+        # The heaviest paths would all be among the longest ones, so random
+        # scores would only pick among those
+        return network.random_paths(start, goal, self.rng)
 
-class TurnAndLengthEstimator:
+
+class TurnAndLengthEstimator(PathEstimator):
     def score_path(self, path, polyline):
         return score_path_polyline(polyline)
 
-class LengthEstimator:
+    def weigh_node(self, node):
+        if node.roadtype in GHOST_TYPES:
+            return 0
+        # Polyline scores count each piece of the path twice plus the angles
+        # between pieces
+        return 2 * node.get_spine().length + math.fabs(node.angle)
+
+class LengthEstimator(PathEstimator):
     def score_path(self, path, polyline):
         return len(path)
 
@@ -303,6 +340,16 @@ class TestSuiteGenerator:
         self.mutators = {}
         self.init_mutators()
         self.sg_idx = 0
+        # Start, goal and path chosen for each network layout, as canonical
+        # positions of the nodes in the fingerprint of the layout
+        self.start_goal_paths = LayoutMemo()
+
+        self.pool = None
+        self.pool_seed = None
+        self.pool_index = 0
+        self.pool_position = None
+        self.pool_stop = None
+        self.pool_worker = None
 
     def init_crossovers(self):
         pass
@@ -466,6 +513,37 @@ class TestSuiteGenerator:
         return None, {}
 
     def determine_start_goal_path(self, network):
+        """
+        Picks start, goal and path of the test for the given network. Layouts
+        seen before get the same choice again without searching.
+        """
+        fingerprint, nodes = network.get_fingerprint()
+        if fingerprint is not None and fingerprint in self.start_goal_paths:
+            choice = self.start_goal_paths.get(fingerprint)
+            if not choice:
+                return None, None, None
+            start, goal, path = choice
+            path = [nodes[idx] for idx in path]
+            start, goal = get_start_goal_coords(network, nodes[start],
+                                                nodes[goal])
+            return start, goal, path
+
+        choice = self.search_start_goal_path(network)
+        if not choice:
+            if fingerprint is not None:
+                self.start_goal_paths.put(fingerprint, None)
+            return None, None, None
+
+        start, goal, path = choice
+        start_coord, goal_coord = get_start_goal_coords(network, start, goal)
+        if fingerprint is not None:
+            positions = {node: idx for idx, node in enumerate(nodes)}
+            choice = (positions[start], positions[goal],
+                      [positions[node] for node in path])
+            self.start_goal_paths.put(fingerprint, choice)
+        return start_coord, goal_coord, path
+
+    def search_start_goal_path(self, network):
         best_start, best_goal = None, None
         best_path = None
         best_score = -1
@@ -487,7 +565,7 @@ class TestSuiteGenerator:
                 #l.info(sg_file)
                 l.info('Checking candidate: (%s, %s), %s/%s', start, goal, candidate_idx, len(candidates))
                 candidate_idx += 1
-                paths = network.all_paths(start, goal)
+                paths = self.estimator.find_paths(network, start, goal)
                 #paths = network.all_shortest_paths(start, goal)
                 start_coord, goal_coord = get_start_goal_coords(network, start, goal)
                 i = 0
@@ -516,12 +594,9 @@ class TestSuiteGenerator:
                 if done < epsilon:
                     break
 
-            best_start, best_goal = get_start_goal_coords(network, best_start,
-                                                          best_goal)
-
             return best_start, best_goal, best_path
 
-        return None, None, None
+        return None
 
     def determine_path(self, test):
         start_node = test.network.get_nodes_at(test.start)
@@ -532,12 +607,119 @@ class TestSuiteGenerator:
         goal_node = goal_node.pop()
         return test.network.shortest_path(start_node, goal_node)
 
+    def start_pool(self):
+        """
+        Starts the worker process keeping the layout pool for the current
+        generation settings topped up, if the evolution config asks for a
+        pool. Tests are taken from the pool in index order, starting where
+        the previous run using the pool stopped. A new pool is seeded from
+        the random number generator of this generator, and every entry only
+        depends on the seed of the pool and its index, so the tests taken
+        from a pool do not depend on how far the worker got.
+        """
+        if c.ev.layout_pool_size < 1 or self.pool_worker:
+            return
+
+        # Drawn either way so the rest of the run does not depend on
+        # whether the pool existed
+        seed = self.next_seed()
+        path = get_pool_path(self.estimator)
+        self.pool = LayoutPool(path)
+        # Claims left behind by runs that did not stop cleanly
+        self.pool.release_all()
+        self.pool_seed = self.pool.get_seed(seed)
+        self.pool_index = self.pool.get_position()
+        self.pool_position = multiprocessing.Value('q', self.pool_index)
+        self.pool_stop = multiprocessing.Event()
+        args = (c.ev, c.rg, self.estimator, path, self.pool_seed,
+                c.ev.layout_pool_size, self.pool_position, self.pool_stop)
+        self.pool_worker = multiprocessing.Process(target=fill_layout_pool,
+                                                   args=args, daemon=True)
+        self.pool_worker.start()
+        l.info('Started layout pool worker for pool %s at entry %s.', path,
+               self.pool_index)
+
+    def stop_pool(self):
+        if self.pool_worker:
+            self.pool_stop.set()
+            self.pool_worker.join()
+            self.pool_worker = None
+        self.pool = None
+
+    def pop_pooled_test(self):
+        """
+        Returns a test made from the next entry of the layout pool, or None
+        if there is no pool.
+        """
+        if self.pool is None:
+            return None
+
+        entry = self.take_pool_entry(self.pool_index)
+        self.pool_index += 1
+        self.pool.set_position(self.pool_index)
+        self.pool_position.value = self.pool_index
+
+        entry['test_id'] = self.next_test_id()
+        test = RoadTest.from_dict(entry)
+        return test
+
+    def take_pool_entry(self, index):
+        """
+        Takes the entry of the given index from the layout pool. Entries the
+        worker has not got to yet are grown here instead, while entries the
+        worker is growing already are waited for.
+        """
+        while True:
+            entry = self.pool.take(index)
+            if entry is not None:
+                return entry
+
+            if self.pool.claim(index):
+                try:
+                    # The worker may have finished the entry in the meantime
+                    entry = self.pool.take(index)
+                    if entry is None:
+                        l.debug('Layout pool lags behind, growing entry %s.',
+                                index)
+                        entry = make_pool_entry(self.pool_seed, index,
+                                                self.estimator)
+                        # Loaded the same way as stored entries
+                        entry = json.loads(json.dumps(entry))
+                finally:
+                    self.pool.release(index)
+                return entry
+
+            if not self.pool_worker.is_alive():
+                self.pool.release(index)
+                continue
+            sleep(POOL_WAIT_INTERVAL)
+
     def generate_single_test(self):
+        test = self.pop_pooled_test()
+        if test:
+            l.debug('Took test %s from the layout pool.', test.test_id)
+            return test
+
         network = generate_networks(self.bounds, [self.next_seed()])[0]
         test = self.test_from_network(network)
         return test
 
+    def get_generation_telemetry(self, tests, generators):
+        return {test.test_id: generators[test.test_id].get_telemetry()
+                for test in tests}
+
     def generate_tests(self, amount):
+        """
+        Grows the networks of the given amount of new tests step by step in
+        a round robin. Besides the tests, the generation events carry the
+        telemetry of their generators, which maps test IDs to the stats of
+        every seed tried for the test as given by
+        RoadGenerator.get_telemetry.
+        """
+        if c.ev.generation_workers > 1:
+            yield from self.generate_tests_parallel(amount)
+            return
+
         ret = []
         todo = []
         generators = {}
@@ -546,16 +728,21 @@ class TestSuiteGenerator:
             test = RoadTest(self.next_test_id(), generator.network, None, None)
             todo.append(test)
             generators[test.test_id] = generator
-        yield ('init_generation', todo)
+        yield ('init_generation', todo,
+               self.get_generation_telemetry(todo, generators))
         echo = todo
         while todo:
             todo_buf = []
             for test in todo:
                 generator = generators[test.test_id]
                 result = generator.grow()
+                # Generators start over on a new network when they restart
+                test.network = generator.network
                 if result != RoadGenerator.done:
                     todo_buf.append(test)
                 else:
+                    l.debug('Generated network of test %s: %s', test.test_id,
+                            generator.stats)
                     if test.network.complete_is_consistent():
                         network = test.network
                         test = self.test_from_network(network)
@@ -565,10 +752,74 @@ class TestSuiteGenerator:
                         test = RoadTest(self.next_test_id(), generator.network, None, None)
                         todo_buf.append(test)
                         generators[test.test_id] = generator
-            yield ('update_generation', echo)
+            yield ('update_generation', echo,
+                   self.get_generation_telemetry(echo, generators))
             todo = todo_buf
         yield ('finish_generation', ret)
 
+    def generate_tests_parallel(self, amount):
+        """
+        Generates tests like generate_tests, but grows their networks to
+        completion in a pool of worker processes. Knowing how many steps
+        each network took, the round robin of generate_tests is replayed so
+        tests finish in the same order and draw the same seeds and test IDs
+        as they would have there, giving identical results. Every round
+        yields an update event as it does there, but since workers only
+        report back once they are done, echoed tests show their network
+        only once it is finished, and events carry the final telemetry of
+        the tests in the echo.
+        """
+        ret = []
+        todo = []
+        pool = GenerationPool(self.bounds)
+        jobs = {}
+        remaining = {}
+        telemetry = {}
+        try:
+            for i in range(amount):
+                seed = self.next_seed()
+                generator = RoadGenerator(self.bounds, seed)
+                test = RoadTest(self.next_test_id(), generator.network, None, None)
+                todo.append(test)
+                jobs[test.test_id] = pool.submit(seed)
+                telemetry[test.test_id] = generator.get_telemetry()
+            yield ('init_generation', todo, {**telemetry})
+            echo = todo
+            while todo:
+                for test in todo:
+                    if test.test_id not in remaining:
+                        result = pool.result(jobs[test.test_id])
+                        remaining[test.test_id] = result[1]
+                        telemetry[test.test_id] = result[3]
+
+                todo_buf = []
+                for test in todo:
+                    remaining[test.test_id] -= 1
+                    if remaining[test.test_id]:
+                        todo_buf.append(test)
+                        continue
+
+                    network, _, consistent, _ = pool.result(
+                        jobs.pop(test.test_id))
+                    # Echoed tests show the network their generator grew
+                    test.network = network
+                    if consistent:
+                        test = self.test_from_network(network)
+                        ret.append(test)
+                    else:
+                        seed = self.next_seed()
+                        generator = RoadGenerator(self.bounds, seed)
+                        test = RoadTest(self.next_test_id(), generator.network, None, None)
+                        todo_buf.append(test)
+                        jobs[test.test_id] = pool.submit(seed)
+                        telemetry[test.test_id] = generator.get_telemetry()
+                yield ('update_generation', echo,
+                       {test.test_id: telemetry[test.test_id] for test in echo})
+                todo = todo_buf
+        finally:
+            pool.close()
+        yield ('finish_generation', ret)
+
     def beg_evol_clock(self):
         self.beg_evol = datetime.datetime.now()
 
@@ -597,6 +848,13 @@ class TestSuiteGenerator:
         return True
 
     def evolve_suite(self, generations):
+        self.start_pool()
+        try:
+            yield from self.run_evolution(generations)
+        finally:
+            self.stop_pool()
+
+    def run_evolution(self, generations):
         # Initialise pop
         l.debug('Starting evolution clock.')
         self.beg_evol_clock()
@@ -619,6 +877,9 @@ class TestSuiteGenerator:
         for _ in range(generations):
             #RoadTest.get_suite_seg_distribution(self.population, 2)
             yield ('evaluated', (self.population, evaluation, total_evol_time, total_eval_time))
+            l.info('Consistency checks: %s', str(CONSISTENCY_STATS))
+            l.info('Consistency verdicts memoised: %s hits, %s misses',
+                   CONSISTENCY_VERDICTS.hits, CONSISTENCY_VERDICTS.misses)
             l.info('Test evolution step: %s', self.step)
             l.debug('Starting evolution clock.')
             self.beg_evol_clock()
@@ -632,9 +893,13 @@ class TestSuiteGenerator:
             yield ('looped', self.population)
 
             if self.random_exp:
-                for state in self.generate_tests(self.max_pop):
-                    if state[0] == 'finish_generation':
-                        nextgen = state[1]
+                if self.pool is not None:
+                    nextgen = [self.pop_pooled_test()
+                               for _ in range(self.max_pop)]
+                else:
+                    for state in self.generate_tests(self.max_pop):
+                        if state[0] == 'finish_generation':
+                            nextgen = state[1]
             else:
                 nextgen = [self.population[-1]]
                 #nextgen = []
@@ -724,3 +989,66 @@ class TestSuiteGenerator:
             yield ('timeout', (self.population, evaluation, total_evol_time, total_eval_time))
         else:
             yield ('finish_evolution', self.population)
+
+
+def make_pool_entry(seed, index, estimator):
+    """
+    Grows the test of the given index in the layout pool of the given seed
+    and returns it in the format of RoadTest.to_dict, minus the test ID.
+    Networks are grown until one is consistent and has a path from start to
+    goal, picked with a copy of the given estimator.
+    """
+    rng = random.Random('{}:{}'.format(seed, index))
+    estimator = copy.deepcopy(estimator)
+    if isinstance(estimator, RandomPathEstimator):
+        # Entries only depend on the seed and their index
+        estimator.rng = rng
+    gen = TestSuiteGenerator(rng, estimator=estimator)
+    while True:
+        network = generate_networks(gen.bounds, [gen.next_seed()],
+                                    workers=1)[0]
+        if not network.complete_is_consistent():
+            continue
+
+        start, goal, path = gen.determine_start_goal_path(network)
+        if not path:
+            continue
+
+        test = RoadTest(0, network, start, goal)
+        test.set_path(path)
+        ret = RoadTest.to_dict(test)
+        del ret['test_id']
+        return ret
+
+
+def fill_layout_pool(ev, rg, estimator, path, seed, size, position, stop):
+    """
+    Keeps the given number of entries ahead of the position the generator
+    is at in the layout pool at the given path, until the stop event is set.
+    Entries the generator already passed are dropped, and indices that have
+    an entry or are claimed by the generator are skipped. Runs in the worker
+    process started by TestSuiteGenerator.start_pool.
+    """
+    c.ev = ev
+    c.rg = rg
+    pool = LayoutPool(path)
+    index = 0
+    # Daemon processes are only stopped when their parent exits cleanly
+    parent = os.getppid()
+    while not stop.is_set() and os.getppid() == parent:
+        beg = position.value
+        pool.discard_before(beg)
+        index = max(index, beg)
+        while pool.has(index) or pool.is_claimed(index):
+            index += 1
+        if index >= beg + size:
+            stop.wait(POOL_POLL_INTERVAL)
+            continue
+
+        if pool.claim(index):
+            try:
+                pool.put(index, make_pool_entry(seed, index, estimator))
+            finally:
+                pool.release(index)
+            l.debug('Added entry %s to the layout pool.', index)
+        index += 1
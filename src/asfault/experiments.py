@@ -107,12 +107,13 @@ def run_experiment(rng, evaluator, selector, estimator, factory, sort_pop, budge
         plotter = EvolutionPlotter()
         plotter.start()
 
-    for step, data in gen.evolve_suite(budget):
+    for state in gen.evolve_suite(budget):
+        step, data = state[:2]
         evo_step += 1
         evo = list()
 
         if plotter:
-            updated = plotter.update((step, data))
+            updated = plotter.update(state)
             if updated:
                 plotter.pause()
                 if render:
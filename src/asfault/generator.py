@@ -1,13 +1,36 @@
 import logging as l
 import random
 
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
 from asfault import config as c
 from asfault.network import *
+from asfault.sampling import FactoryTable
 
 OPPOSITE_PRECISION = 10000
 MAX_GOAL_ANGLE = 179
 ANCHOR_OFFSET = 0.05
 
+# Verifies every incremental consistency check against the full one
+CHECK_FULL_CONSISTENCY = False
+
+FACTORY_GROUPS = (TYPE_STRAIGHT, TYPE_L_TURN, TYPE_R_TURN)
+FACTORY_TABLE = None
+
+RESTART_NONE = 'none'
+RESTART_BUDGET = 'budget'
+RESTART_LUBY = 'luby'
+# Restarts after which a fixed step budget doubles
+RESTART_ESCALATION = 10
+
+REJECT_EXHAUSTED = 'exhausted'
+REJECT_HOPELESS = 'hopeless'
+REJECT_GOAL = 'goal'
+REJECT_CONSISTENCY = 'consistency'
+REJECT_BRANCH_LENGTHS = 'branch_lengths'
+
 
 def dummy_lanes(start_id, count):
     ret = []
@@ -18,24 +41,158 @@ def dummy_lanes(start_id, count):
     return ret
 
 
+def get_factory_group(key):
+    for group in FACTORY_GROUPS:
+        if key.startswith(group):
+            return group
+    return key
+
+
+def get_factory_table():
+    """
+    Returns the table of the segment factories all generators sample from,
+    rebuilding it if the set of factories changed.
+    """
+    global FACTORY_TABLE
+    if FACTORY_TABLE is None or FACTORY_TABLE.keys != tuple(SEG_FACTORIES):
+        FACTORY_TABLE = FactoryTable(SEG_FACTORIES, get_factory_group)
+    return FACTORY_TABLE
+
+
+def luby(index):
+    """
+    Returns the term of the given index, counting from 1, of the Luby
+    sequence 1, 1, 2, 1, 1, 2, 4, 1, 1, 2, 1, 1, 2, 4, 8, ...
+    """
+    while True:
+        k = 1
+        while (1 << k) - 1 < index:
+            k += 1
+        if index == (1 << k) - 1:
+            return 1 << (k - 1)
+        index -= (1 << (k - 1)) - 1
+
+
+def get_step_budget(restarts, policy=None, budget=None):
+    """
+    Returns the number of grow steps a generator gets on a seed after having
+    restarted the given number of times, or None if seeds are never
+    abandoned. The policy and the budget, which is the unit of the schedule
+    for Luby restarts, default to the ones set in the evolution config.
+    Fixed budgets double every RESTART_ESCALATION restarts, so generation
+    still finishes when the budget is too small to grow a whole network.
+    Luby schedules reach ever larger budgets by themselves.
+    """
+    if policy is None:
+        policy = c.ev.generation_restarts
+    if budget is None:
+        budget = c.ev.generation_step_budget
+
+    if policy == RESTART_NONE or not budget:
+        return None
+    if policy == RESTART_BUDGET:
+        return budget * 2 ** (restarts // RESTART_ESCALATION)
+    if policy == RESTART_LUBY:
+        return budget * luby(restarts + 1)
+    raise ValueError('Unknown restart policy: {}'.format(policy))
+
+
+def derive_seed(seed, restarts):
+    """
+    Returns the seed a generator started with the given seed continues with
+    after the given number of restarts.
+    """
+    rng = random.Random('{}:{}'.format(seed, restarts))
+    return rng.randint(0, 2 ** 32 - 1)
+
+
+class GenerationStats:
+    """
+    Number of grow steps a generator took on one seed, how many of them grew
+    and shrank the network, how many extensions each check rejected, and the
+    total time in seconds spent growing.
+    """
+
+    def __init__(self, seed):
+        self.seed = seed
+        self.steps = 0
+        self.grown = 0
+        self.shrank = 0
+        self.rejects = defaultdict(int)
+        self.time = 0.0
+
+    def record(self, result, duration):
+        self.steps += 1
+        if result == RoadGenerator.grown:
+            self.grown += 1
+        elif result == RoadGenerator.shrank:
+            self.shrank += 1
+        self.time += duration
+
+    def reject(self, check):
+        self.rejects[check] += 1
+
+    def to_dict(self):
+        return {'seed': self.seed,
+                'steps': self.steps,
+                'grown': self.grown,
+                'shrank': self.shrank,
+                'rejects': dict(self.rejects),
+                'time': self.time}
+
+    def __str__(self):
+        rejects = ', '.join('{}: {}'.format(check, count)
+                            for check, count in self.rejects.items())
+        return 'seed {}: {} steps, {} grown, {} shrank ({}) in {:.3f}s'.format(
+            self.seed, self.steps, self.grown, self.shrank, rejects, self.time)
+
+
 class RoadGenerator:
     grown = 2
     done = 0
     shrank = 1
 
     def __init__(self, bounds, seed):
+        self.bounds = bounds
+        self.first_seed = seed
+        self.restarts = 0
+        # Stats of every seed tried, the current one last
+        self.attempts = []
+        self.factories = get_factory_table()
+        self.start_seed(seed)
+
+    def start_seed(self, seed):
         self.seed = seed
         self.rng = random.Random()
         self.rng.seed(seed)
 
         self.extension_stack = []
+        # Bitmask of the factory groups still available at each dead end
         self.available_ext = {}
         self.last_ext_key = {}
 
-        self.network = NetworkLayout(bounds)
-        self.root, self.start, self.goal = self.place_root(bounds)
+        self.network = NetworkLayout(self.bounds)
+        self.root, self.start, self.goal = self.place_root(self.bounds)
+        self.goal_coords = (self.goal.x, self.goal.y)
         self.network.add_node(self.root)
 
+        self.stats = GenerationStats(seed)
+        self.attempts.append(self.stats)
+        self.budget = get_step_budget(self.restarts)
+
+    def restart(self):
+        """
+        Abandons the current seed and starts over with a new network grown
+        from a seed derived from the first one.
+        """
+        l.info('Abandoning seed %s after %s steps.', self.seed,
+               self.stats.steps)
+        self.restarts += 1
+        self.start_seed(derive_seed(self.first_seed, self.restarts))
+
+    def get_telemetry(self):
+        return [stats.to_dict() for stats in self.attempts]
+
     def place_root(self, bounds):
         start, goal = self.random_start_goal(bounds)
         centre = bounds.centroid
@@ -51,9 +208,8 @@ class RoadGenerator:
         root.r_lanes = r_lanes
         root_point = Point(root.x_off, root.y_off)
         distance = root_point.distance(self.network.bounds)
-        first_fac = generate_straight_factory(
+        self.first_fac = generate_straight_factory(
             'straight_{}'.format(distance * 2), distance * 2)
-        self.available_ext[root] = {'first': first_fac}
         return root, start, goal
 
     def random_start_goal(self, bounds):
@@ -106,19 +262,53 @@ class RoadGenerator:
 
     def extend(self, ext_point):
         l.debug('Attempting to extend from point: %s', str(ext_point))
+        if ext_point == self.root:
+            # Roots always start off with a straight segment reaching the
+            # far side of the map
+            self.last_ext_key[ext_point] = 'first'
+            return self.first_fac(self.next_seg_id(), ext_point)
+
         if ext_point not in self.available_ext:
-            self.available_ext[ext_point] = {**SEG_FACTORIES}
+            self.available_ext[ext_point] = self.factories.full
+
+        while self.available_ext[ext_point]:
+            fac_key = self.factories.sample(self.rng,
+                                            self.available_ext[ext_point])
+            if self.is_hopeless(ext_point, fac_key):
+                # Same outcome as growing and shrinking again, minus building
+                # and checking the segment
+                l.debug('Extension with %s is hopeless. Skipping.', fac_key)
+                self.stats.reject(REJECT_HOPELESS)
+                self.discard_extensions(ext_point, fac_key)
+                continue
 
-        available = self.available_ext[ext_point]
-        if available:
-            fac_key, factory = self.rng.sample(available.items(), 1)[0]
             l.debug('Extending with: %s', fac_key)
             self.last_ext_key[ext_point] = fac_key
-            assert factory
+            factory = SEG_FACTORIES[fac_key]
             extensions = factory(self.next_seg_id(), ext_point)
             return extensions
-        else:
-            return None
+
+        return None
+
+    def is_hopeless(self, ext_point, fac_key):
+        """
+        Tells if extending the given dead end with the factory of the given
+        key would certainly be undone by grow, either for not approaching
+        the goal or for overlapping the branch. The footprint of the factory
+        is placed at the dead end instead of building the segment.
+        """
+        turtle = self.network.get_exit_turtle(ext_point)
+        if turtle is None:
+            return False
+
+        footprint = get_segment_footprint(fac_key, ext_point)
+        outline, front = footprint.place(turtle)
+        par_dist = self.get_goal_distance(ext_point)
+        seg_dist = self.get_front_goal_distance(front)
+        if par_dist < seg_dist:
+            return True
+
+        return self.network.is_extension_blocked(ext_point, outline)
 
     def seg_oob(self, segment):
         line = segment.get_front_line()
@@ -154,10 +344,13 @@ class RoadGenerator:
         return True
 
     def get_goal_distance(self, node):
-        front = node.get_front_line()
-        front_centre = front.interpolate(0.5, normalized=True)
-        goal_line = LineString([front_centre, self.goal])
-        return goal_line.length
+        return self.get_front_goal_distance(node.get_cross_sections()[-1])
+
+    def get_front_goal_distance(self, front):
+        x, y = get_line_centre(front)
+        x_diff = self.goal_coords[0] - x
+        y_diff = self.goal_coords[1] - y
+        return math.sqrt(x_diff * x_diff + y_diff * y_diff)
 
     def is_closer_to_goal(self, frontier):
         for parent, segments in frontier.items():
@@ -172,6 +365,19 @@ class RoadGenerator:
         return True
 
     def grow(self):
+        """
+        Takes one grow step, first restarting on a new seed if the step
+        budget of the current one is spent.
+        """
+        if self.budget is not None and self.stats.steps >= self.budget:
+            self.restart()
+
+        beg = perf_counter()
+        ret = self.grow_step()
+        self.stats.record(ret, perf_counter() - beg)
+        return ret
+
+    def grow_step(self):
         l.debug('Attempting to grow road network.')
         ext_points = self.network.find_dead_ends()
         l.debug('Found %s extension points.', len(ext_points))
@@ -182,6 +388,7 @@ class RoadGenerator:
             if extensions:
                 growth[ext_point] = extensions
             else:
+                self.stats.reject(REJECT_EXHAUSTED)
                 self.shrink()
                 return RoadGenerator.shrank
 
@@ -200,11 +407,22 @@ class RoadGenerator:
 
             if not self.is_closer_to_goal(growth):
                 l.debug('Expansion did not approach goal. Undoing.')
+                self.stats.reject(REJECT_GOAL)
                 self.shrink()
                 return RoadGenerator.shrank
 
-            if not self.network.is_consistent():
+            segments = []
+            for extensions in growth.values():
+                segments.extend(extensions)
+            # Grown networks are consistent, so only the growth needs to be
+            # checked
+            consistent = self.network.check_growth(segments)
+            if CHECK_FULL_CONSISTENCY:
+                assert consistent == self.network.is_consistent()
+
+            if not consistent:
                 l.debug('Intersections found. Undoing growth.')
+                self.stats.reject(REJECT_CONSISTENCY)
                 self.shrink()
                 return RoadGenerator.shrank
             else:
@@ -213,6 +431,7 @@ class RoadGenerator:
                 return RoadGenerator.grown
 
         if not self.network.check_branch_lengths():
+            self.stats.reject(REJECT_BRANCH_LENGTHS)
             self.shrink()
             return RoadGenerator.shrank
 
@@ -222,23 +441,117 @@ class RoadGenerator:
         growth = self.extension_stack.pop()
         for parent, extensions in growth.items():
             assert parent in self.last_ext_key
-            assert parent in self.available_ext
             fac_key = self.last_ext_key[parent]
-            available = self.available_ext[parent]
             if parent != self.root:
-                todo = set()
-                for key in available.keys():
-                    if key[0] == fac_key[0]:
-                        todo.add(key)
-                for key in todo:
-                    del available[key]
+                assert parent in self.available_ext
+                self.discard_extensions(parent, fac_key)
                 #del available[fac_key]
             for extension in extensions:
                 self.network.remove_node(extension)
 
+    def discard_extensions(self, parent, fac_key):
+        # Factories of the same road type as a failed one are not tried again
+        available = self.available_ext[parent]
+        self.available_ext[parent] = self.factories.remove_group(available,
+                                                                 fac_key)
+
+
+def grow_network(bounds, seed):
+    """
+    Grows the network of the given seed to completion. Returns the network
+    along with the number of grow steps it took, including the final one
+    and those spent on abandoned seeds, whether the finished network is
+    consistent and the telemetry of the generator.
+    """
+    gen = RoadGenerator(bounds, seed)
+    steps = 1
+    while gen.grow() != RoadGenerator.done:
+        steps += 1
+    return gen.network, steps, gen.network.complete_is_consistent(), \
+        gen.get_telemetry()
+
+
+def grow_network_job(bounds, seed):
+    """
+    Runs grow_network in a worker process. Returns its result along with the
+    stats of the consistency checks run for it and the hits and misses of
+    the verdict memo, so they can be merged into those of the parent.
+    """
+    CONSISTENCY_STATS.clear()
+    CONSISTENCY_VERDICTS.hits = 0
+    CONSISTENCY_VERDICTS.misses = 0
+    ret = grow_network(bounds, seed)
+    return ret, CONSISTENCY_STATS, CONSISTENCY_VERDICTS.hits, \
+        CONSISTENCY_VERDICTS.misses
+
+
+def init_worker(ev):
+    c.ev = ev
+
+
+class GenerationPool:
+    """
+    Pool of worker processes growing networks from seeds with grow_network.
+    Generators only depend on their seed and the evolution config, which is
+    handed to every worker, so networks come out of the pool exactly as
+    they would have been grown in this process. Finished networks are
+    pickled back without their derived geometry. The consistency checks run
+    by workers count towards CONSISTENCY_STATS and CONSISTENCY_VERDICTS of
+    this process once their job's result has been fetched.
+    """
+
+    def __init__(self, bounds, workers=None):
+        if workers is None:
+            workers = c.ev.generation_workers
+        self.bounds = bounds
+        self.executor = ProcessPoolExecutor(max_workers=workers,
+                                            initializer=init_worker,
+                                            initargs=(c.ev,))
+        self.jobs = []
+        self.merged = set()
+
+    def submit(self, seed):
+        job = self.executor.submit(grow_network_job, self.bounds, seed)
+        self.jobs.append(job)
+        return job
+
+    def result(self, job):
+        """
+        Waits for the given job and returns the result of grow_network for
+        it, merging the worker's check stats on the first call.
+        """
+        ret, stats, hits, misses = job.result()
+        if job not in self.merged:
+            self.merged.add(job)
+            CONSISTENCY_STATS.merge(stats)
+            CONSISTENCY_VERDICTS.hits += hits
+            CONSISTENCY_VERDICTS.misses += misses
+        return ret
+
+    def close(self):
+        for job in self.jobs:
+            job.cancel()
+        self.jobs = []
+        self.merged = set()
+        self.executor.shutdown()
+
+
+def generate_networks(bounds, seeds, workers=None):
+    if workers is None:
+        workers = c.ev.generation_workers
 
-def generate_networks(bounds, seeds):
     ret = []
+    if workers > 1 and len(seeds) > 1:
+        pool = GenerationPool(bounds, workers)
+        try:
+            jobs = [pool.submit(seed) for seed in reversed(seeds)]
+            seeds.clear()
+            for job in jobs:
+                ret.append(pool.result(job)[0])
+        finally:
+            pool.close()
+        return ret
+
     while seeds:
         seed = seeds.pop()
         gen = RoadGenerator(bounds, seed)
@@ -2,17 +2,25 @@ import itertools
 import logging as l
 import math
 
+from collections import OrderedDict, defaultdict
+from time import perf_counter
+
 import networkx
-from networkx.algorithms.shortest_paths import has_path, shortest_path, \
-    shortest_path_length
+import numpy as np
+from networkx.algorithms.shortest_paths import has_path, shortest_path
+from networkx.algorithms.components import strongly_connected_components
+from networkx.algorithms.dag import topological_sort
 from networkx.algorithms.simple_paths import all_simple_paths
 from networkx.algorithms.shortest_paths import shortest_path, all_shortest_paths
-from pyqtree import Index
+from scipy.optimize import linear_sum_assignment
 from shapely import affinity
-from shapely.geometry import Point, LineString, Polygon
+from shapely.geometry import Point, LineString, Polygon, box
 from shapely.prepared import prep
 
 from asfault import config as c
+from asfault.parentage import Parentage
+from asfault.paths import best_paths, random_paths, weigh_count
+from asfault.spatial import create_index
 
 TYPE_ROOT = 'root'
 TYPE_L_TURN = 'l_turn'
@@ -21,6 +29,10 @@ TYPE_STRAIGHT = 'straight'
 
 GHOST_TYPES = (TYPE_ROOT)
 
+BOUNDS_INSIDE = 'inside'
+BOUNDS_OUTSIDE = 'outside'
+BOUNDS_STRADDLING = 'straddling'
+
 SLOT_COUNT = 3
 SLOT_DISTANCE = 1
 MIN_SLOT_DISTANCE = 5
@@ -28,38 +40,110 @@ MIN_SLOT_DISTANCE = 5
 DEFAULT_TURTLE_HEAD = ((0.0, 0.0), (0.0, 1.0))
 
 SEG_FACTORIES = {}
+SEG_FOOTPRINTS = {}
+
+SEG_TEMPLATES = OrderedDict()
+SEG_TEMPLATE_LIMIT = 4096
+
+FINGERPRINT_QUANTUM = 1e-6
+LAYOUT_MEMO_LIMIT = 4096
+
+
+def get_arc_lengths(coords):
+    """
+    Returns the arc length along the polyline with the given (n, 2)
+    coordinates at each of its vertices, normalised by the length of the
+    line. The values match what LineString.project(normalized=True) gives
+    for the vertices of a line that does not run over itself.
+    """
+    steps = np.diff(coords, axis=0)
+    steps = np.sqrt(steps[:, 0] * steps[:, 0] + steps[:, 1] * steps[:, 1])
+    ret = np.concatenate(([0.0], np.cumsum(steps)))
+    if ret[-1] > 0:
+        ret /= ret[-1]
+    return ret
+
+
+def get_line_centre(coords):
+    """
+    Returns the point halfway along the polyline with the given (n, 2)
+    coordinates, as LineString.interpolate(0.5, normalized=True) would.
+    Meant for short lines like cross-sections, which are walked in plain
+    Python.
+    """
+    coords = coords.tolist()
+    lengths = []
+    for (x_beg, y_beg), (x_end, y_end) in zip(coords, coords[1:]):
+        x_diff = x_end - x_beg
+        y_diff = y_end - y_beg
+        lengths.append(math.sqrt(x_diff * x_diff + y_diff * y_diff))
+
+    remaining = sum(lengths) * 0.5
+    for idx, length in enumerate(lengths):
+        if length > 0 and (remaining <= length or idx == len(lengths) - 1):
+            frac = remaining / length
+            x_beg, y_beg = coords[idx]
+            x_end, y_end = coords[idx + 1]
+            return (x_beg + frac * (x_end - x_beg),
+                    y_beg + frac * (y_end - y_beg))
+        remaining -= length
+    return tuple(coords[0])
+
+
+def split_coords(line, coords, dists, point_dist):
+    # Vertices strictly before the split point go to the beginning, the
+    # rest to the end of the line
+    count = int(np.searchsorted(dists, point_dist, side='left'))
+    point = line.interpolate(point_dist, normalized=True)
+
+    beg_coords = coords[:count].tolist()
+    if not beg_coords:
+        beg_coords.append(coords[0].tolist())
+    beg_coords.append(point)
+
+    end_coords = [point]
+    end_coords.extend(coords[count:].tolist())
+    if len(end_coords) < 2:
+        end_coords.append(coords[-1].tolist())
+
+    beg = LineString(beg_coords)
+    end = LineString(end_coords)
+    return beg, end
+
+
+def split_at(line, point_dist):
+    """
+    Splits the given line at the given normalised distance along it and
+    returns the part before and after that point.
+    """
+    coords = to_coords(line)
+    return split_coords(line, coords, get_arc_lengths(coords), point_dist)
 
 
 def split(line, point):
-    coords = list(line.coords)
     if point.geom_type != 'Point':
         l.error('Point is: %s', point.geom_type)
         raise ValueError('Not a point!')
     point_dist = line.project(point, normalized=True)
-    beg_coords = []
-    while coords:
-        coord = Point(*coords[0])
-        if coord.geom_type != 'Point':
-            l.error('Point is: %s', coord.geom_type)
+    return split_at(line, point_dist)
+
+
+def split_many(line, points):
+    """
+    Splits the given line at each of the given points and returns a
+    (beginning, end) pair of lines for every point. The arc lengths of the
+    line are computed once for all points.
+    """
+    coords = to_coords(line)
+    dists = get_arc_lengths(coords)
+    ret = []
+    for point in points:
+        if point.geom_type != 'Point':
+            l.error('Point is: %s', point.geom_type)
             raise ValueError('Not a point!')
-        coord_dist = line.project(coord, normalized=True)
-        if coord_dist < point_dist:
-            beg_coords.append(coord)
-            coords.pop(0)
-        else:
-            break
-    if not beg_coords:
-        beg_coords.append(line.coords[0])
-    beg_coords.append(line.interpolate(point_dist, normalized=True))
-
-    end_coords = [line.interpolate(point_dist, normalized=True)]
-    end_coords.extend(coords)
-    if len(end_coords) < 2:
-        end_coords.append(line.coords[-1])
-
-    beg = LineString(beg_coords)
-    end = LineString(end_coords)
-    return beg, end
+        point_dist = line.project(point, normalized=True)
+        ret.append(split_coords(line, coords, dists, point_dist))
+    return ret
 
 
 def get_outer_edge(node, direction):
@@ -74,6 +158,110 @@ def get_outer_edge(node, direction):
         return node.l_lanes[-1].abs_l_edge
 
 
+def classify_box(bbox, bounds):
+    """
+    Tells if the given (minx, miny, maxx, maxy) box lies strictly inside or
+    strictly outside of the given bounds box, or touches its border.
+    """
+    if bbox[0] > bounds[0] and bbox[1] > bounds[1] and \
+            bbox[2] < bounds[2] and bbox[3] < bounds[3]:
+        return BOUNDS_INSIDE
+    if bbox[2] < bounds[0] or bbox[0] > bounds[2] or \
+            bbox[3] < bounds[1] or bbox[1] > bounds[3]:
+        return BOUNDS_OUTSIDE
+    return BOUNDS_STRADDLING
+
+
+def quantise(value):
+    return int(round(value / FINGERPRINT_QUANTUM))
+
+
+class LayoutMemo:
+    """
+    Bounded memo of results computed for network layouts, keyed by layout
+    fingerprint. The least recently used entry is dropped once the memo is
+    full.
+    """
+
+    def __init__(self, limit=LAYOUT_MEMO_LIMIT):
+        self.limit = limit
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, fingerprint):
+        ret = fingerprint in self.entries
+        if ret:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return ret
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, fingerprint):
+        self.entries.move_to_end(fingerprint)
+        return self.entries[fingerprint]
+
+    def put(self, fingerprint, value):
+        self.entries[fingerprint] = value
+        self.entries.move_to_end(fingerprint)
+        if len(self.entries) > self.limit:
+            self.entries.popitem(last=False)
+
+
+CONSISTENCY_VERDICTS = LayoutMemo()
+
+
+class CheckStats:
+    """
+    Number of calls, number of rejections and total time in seconds of each
+    consistency check run.
+    """
+
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.rejects = defaultdict(int)
+        self.times = defaultdict(float)
+
+    def record(self, check, passed, duration):
+        self.calls[check] += 1
+        if not passed:
+            self.rejects[check] += 1
+        self.times[check] += duration
+
+    def merge(self, other):
+        for check, calls in other.calls.items():
+            self.calls[check] += calls
+            self.rejects[check] += other.rejects[check]
+            self.times[check] += other.times[check]
+
+    def clear(self):
+        self.calls.clear()
+        self.rejects.clear()
+        self.times.clear()
+
+    def to_dict(self):
+        ret = {}
+        for check, calls in self.calls.items():
+            ret[check] = {'calls': calls,
+                          'rejects': self.rejects[check],
+                          'time': self.times[check]}
+        return ret
+
+    def __str__(self):
+        ret = []
+        for check, stats in self.to_dict().items():
+            ret.append('{}: {}/{} rejected in {:.3f}s'.format(
+                check, stats['rejects'], stats['calls'], stats['time']))
+        return ', '.join(ret)
+
+
+# Stats of the consistency checks of all networks
+CONSISTENCY_STATS = CheckStats()
+
+
 def split_intersection(a_dir, a_edge, b_dir, b_edge):
     if not a_edge or not b_edge:
         return None
@@ -143,30 +331,161 @@ def buffer_coords(network, coords, path, directions, idx):
         coords.extend(reversed(list(edge.coords)))
 
 
+def get_rotation(angle):
+    # Same angle conversion and snapping as shapely.affinity.rotate so that
+    # materialised coordinates match the ones shapely would produce
+    theta = angle * math.pi / 180.0
+    cosp = math.cos(theta)
+    sinp = math.sin(theta)
+    if math.fabs(cosp) < 2.5e-16:
+        cosp = 0.0
+    if math.fabs(sinp) < 2.5e-16:
+        sinp = 0.0
+    return cosp, sinp
+
+
+def get_transform(x, y, angle):
+    """
+    Returns the 2x3 affine matrix that rotates coordinates by the given angle
+    around the origin and then translates them by (x, y).
+    """
+    cosp, sinp = get_rotation(angle)
+    return np.array([[cosp, -sinp, x], [sinp, cosp, y]], dtype=np.float64)
+
+
+def to_coords(geometry):
+    if geometry is None:
+        return None
+    if hasattr(geometry, 'coords'):
+        geometry = geometry.coords
+    return np.asarray(geometry, dtype=np.float64).reshape(-1, 2)
+
+
+def share_coords(coords):
+    """
+    Read-only coordinate arrays stem from shared segment templates and can be
+    handed out as they are. Writable ones are private to their owner and get
+    copied.
+    """
+    if coords.flags.writeable:
+        return coords.copy()
+    return coords
+
+
+def get_coord_difference(own_coords, oth_coords):
+    """
+    Sums the distances between corresponding coordinates of two stacks of
+    (n, 2) coordinate arrays of the same leading shape. Coordinates past the
+    end of the shorter arrays are ignored as zip would, and so is NaN
+    padding.
+    """
+    count = min(own_coords.shape[-2], oth_coords.shape[-2])
+    deltas = own_coords[..., :count, :] - oth_coords[..., :count, :]
+    dists = np.sqrt(deltas[..., 0] * deltas[..., 0] +
+                    deltas[..., 1] * deltas[..., 1])
+    return float(np.nansum(dists))
+
+
+def get_pose_costs(own_poses, oth_poses):
+    """
+    Returns the matrix of differences between each of the given (x, y,
+    angle) poses and each of the other poses, which is the distance of their
+    positions plus the difference of their angles.
+    """
+    deltas = own_poses[:, None, :] - oth_poses[None, :, :]
+    dists = np.sqrt(deltas[..., 0] * deltas[..., 0] +
+                    deltas[..., 1] * deltas[..., 1])
+    return dists + np.abs(deltas[..., 2])
+
+
+def get_layout_difference(own_arrays, oth_arrays):
+    """
+    Computes the difference of two networks from the arrays returned by
+    NetworkLayout.get_difference_arrays, which need to be padded to the same
+    shape. Roots are paired by an optimal assignment on their poses and the
+    branches of paired roots are compared node by node.
+    """
+    own_poses, own_lengths, own_counts, own_coords = own_arrays
+    oth_poses, oth_lengths, oth_counts, oth_coords = oth_arrays
+
+    diff = math.fabs(len(own_poses) - len(oth_poses))
+    if not len(own_poses) or not len(oth_poses):
+        return diff
+
+    costs = get_pose_costs(own_poses, oth_poses)
+    rows, cols = linear_sum_assignment(costs)
+    diff += float(costs[rows, cols].sum())
+    diff += float(np.abs(own_lengths[rows] - oth_lengths[cols]).sum())
+    # Padding is NaN, so nodes and lanes past the end of the shorter branch
+    # or node are skipped
+    diff += float(np.nansum(np.abs(own_counts[rows] - oth_counts[cols])))
+    diff += get_coord_difference(own_coords[rows], oth_coords[cols])
+    return diff
+
+
+def transform_coords(coords, matrices, index=None):
+    """
+    Applies affine matrices to an (n, 2) array of coordinates. If index is
+    given, matrices is a stack of 2x3 matrices and index holds the matrix to
+    use for each coordinate, allowing many segments to be transformed in one
+    go. Otherwise, matrices is a single 2x3 matrix used for all coordinates.
+    """
+    if index is not None:
+        matrices = matrices[index]
+        a, b, xoff = matrices[:, 0, 0], matrices[:, 0, 1], matrices[:, 0, 2]
+        d, e, yoff = matrices[:, 1, 0], matrices[:, 1, 1], matrices[:, 1, 2]
+    else:
+        a, b, xoff = matrices[0]
+        d, e, yoff = matrices[1]
+
+    x = coords[:, 0]
+    y = coords[:, 1]
+    ret = np.empty_like(coords)
+    ret[:, 0] = a * x + b * y + xoff
+    ret[:, 1] = d * x + e * y + yoff
+    return ret
+
+
 class Turtle:
 
     def __init__(self, pos=(0, 0), pivot=(0, 0), angle=0):
         self.pos = list(pos)
         self.pivot = list(pivot)
         self.angle = angle
-        self.head_vec = LineString([*DEFAULT_TURTLE_HEAD])
 
-    def move(self, node):
-        offset_vec = LineString([(0, 0), (node.x_off, node.y_off)])
-        offset_vec = affinity.rotate(offset_vec, self.angle, origin=(0, 0))
+    @staticmethod
+    def from_pose(pose):
+        x, y, angle, x_piv, y_piv = pose
+        return Turtle(pos=(x, y), pivot=(x_piv, y_piv), angle=angle)
+
+    def get_pose(self):
+        """
+        Returns the state of this turtle as a tuple of plain floats, (x, y,
+        angle, x_piv, y_piv), which from_pose turns back into a turtle.
+        """
+        return (float(self.pos[0]), float(self.pos[1]), float(self.angle),
+                float(self.pivot[0]), float(self.pivot[1]))
+
+    @property
+    def head_vec(self):
+        cosp, sinp = get_rotation(self.angle)
+        coords = []
+        for x, y in DEFAULT_TURTLE_HEAD:
+            coords.append((cosp * x - sinp * y + self.pos[0],
+                           sinp * x + cosp * y + self.pos[1]))
+        return LineString(coords)
+
+    def get_transform(self):
+        return get_transform(self.pos[0], self.pos[1], self.angle)
 
-        self.pos[0] += offset_vec.coords[-1][0]
-        self.pos[1] += offset_vec.coords[-1][1]
+    def move(self, node):
+        cosp, sinp = get_rotation(self.angle)
+        self.pos[0] += cosp * node.x_off - sinp * node.y_off
+        self.pos[1] += sinp * node.x_off + cosp * node.y_off
         self.angle += node.angle
         self.angle %= 360
         self.pivot = [node.x_piv, node.y_piv]
 
-        new_head_vec = LineString([*DEFAULT_TURTLE_HEAD])
-        new_head_vec = affinity.rotate(new_head_vec, self.angle, origin=(0, 0))
-        new_head_vec = affinity.translate(new_head_vec, xoff=self.pos[0],
-                                          yoff=self.pos[1])
-        self.head_vec = new_head_vec
-
 
 def find_pivot(fan, angle, pivot_off, pivot_angle):
     coords = fan.coords
@@ -229,6 +548,70 @@ def place_slots(seg):
     seg.right_slots = place_slots_line(right, 'right')
 
 
+def lines_to_edges(lines):
+    # Stack the cross-section lines and transpose them so that every row
+    # holds the coordinates of one lane edge along the segment
+    edges = np.array([line.coords for line in lines], dtype=np.float64)
+    return edges.transpose(1, 0, 2).copy()
+
+
+class SegmentTemplate:
+    """
+    Relative lane geometry produced by a segment factory for one lane
+    configuration. Templates are shared by every node built from them, so
+    their edge array is read-only; nodes that are edited replace their own
+    coordinate arrays instead of writing into the template.
+    """
+
+    def __init__(self, edges, x_off=0, y_off=0, x_piv=0, y_piv=0):
+        self.edges = edges
+        self.edges.flags.writeable = False
+        self.x_off = x_off
+        self.y_off = y_off
+        self.x_piv = x_piv
+        self.y_piv = y_piv
+
+
+def get_segment_template(key, builder):
+    key = (*key, c.ev.lane_width, c.ev.max_angle)
+    template = SEG_TEMPLATES.get(key, None)
+    if template:
+        SEG_TEMPLATES.move_to_end(key)
+        return template
+
+    template = builder()
+    SEG_TEMPLATES[key] = template
+    if len(SEG_TEMPLATES) > SEG_TEMPLATE_LIMIT:
+        SEG_TEMPLATES.popitem(last=False)
+    return template
+
+
+def build_straight_template(length, l_lanes_c, r_lanes_c):
+    beg_line = buffer_line(-l_lanes_c, r_lanes_c, 0, 0, 0, True)
+    end_line = buffer_line(-l_lanes_c, r_lanes_c, 0, length, 0, True)
+    edges = lines_to_edges([beg_line, end_line])
+    return SegmentTemplate(edges, x_off=0, y_off=length)
+
+
+def build_turn_template(angle, piv_off, piv_ang, l_lanes_c, r_lanes_c):
+    back_line = buffer_line(-l_lanes_c, r_lanes_c, 0, 0, 0, True)
+    pivot = find_pivot(back_line, angle, piv_off, piv_ang)
+    lines = [back_line]
+    steps = int(math.fabs(math.ceil(angle / c.ev.max_angle)))
+    todo = steps
+    step_angle = angle / steps
+    while todo:
+        line = affinity.rotate(lines[-1], step_angle, origin=pivot)
+        lines.append(line)
+        todo -= 1
+
+    coords = lines[-1].coords
+    return SegmentTemplate(lines_to_edges(lines),
+                           x_off=coords[l_lanes_c][0],
+                           y_off=coords[l_lanes_c][1],
+                           x_piv=pivot[0], y_piv=pivot[1])
+
+
 def generate_straight_factory(key, length=0.5):
     def fac_straight(seg_id, parent, rkey=key):
         l_lanes_c = len(parent.l_lanes)
@@ -238,9 +621,10 @@ def generate_straight_factory(key, length=0.5):
         child = NetworkNode(seg_id, TYPE_STRAIGHT, rkey, **options)
         child.length = length
 
-        beg_line = buffer_line(-l_lanes_c, r_lanes_c, 0, 0, 0, True)
-        end_line = buffer_line(-l_lanes_c, r_lanes_c, 0, length, 0, True)
-        child.manifest_lanes([beg_line, end_line], l_lanes_c, r_lanes_c)
+        template = get_segment_template(
+            (TYPE_STRAIGHT, length, l_lanes_c, r_lanes_c),
+            lambda: build_straight_template(length, l_lanes_c, r_lanes_c))
+        child.manifest_edges(template.edges, l_lanes_c, r_lanes_c)
 
         # place_slots(child)
 
@@ -262,23 +646,16 @@ def generate_turn_factory(key, angle=90, pivot_off=1.05, pivot_angle=0):
 
         child = NetworkNode(seg_id, roadtype, rkey, angle=angle)
 
-        back_line = buffer_line(-l_lanes_c, r_lanes_c, 0, 0, 0, True)
-        pivot = find_pivot(back_line, angle, piv_off, piv_ang)
-        lines = [back_line]
-        steps = int(math.fabs(math.ceil(angle / c.ev.max_angle)))
-        todo = steps
-        step_angle = angle / steps
-        while todo:
-            line = affinity.rotate(lines[-1], step_angle, origin=pivot)
-            lines.append(line)
-            todo -= 1
-        child.manifest_lanes(lines, l_lanes_c, r_lanes_c)
+        template = get_segment_template(
+            (roadtype, angle, piv_off, piv_ang, l_lanes_c, r_lanes_c),
+            lambda: build_turn_template(angle, piv_off, piv_ang, l_lanes_c,
+                                        r_lanes_c))
+        child.manifest_edges(template.edges, l_lanes_c, r_lanes_c)
 
-        coords = lines[-1].coords
-        child.x_off = coords[l_lanes_c][0]
-        child.y_off = coords[l_lanes_c][1]
-        child.x_piv = pivot[0]
-        child.y_piv = pivot[1]
+        child.x_off = template.x_off
+        child.y_off = template.y_off
+        child.x_piv = template.x_piv
+        child.y_piv = template.y_piv
 
         child.pivot_off = piv_off
         child.pivot_angle = piv_ang
@@ -312,6 +689,48 @@ def generate_factories():
     generate_turn_factories('r_turn_{}_{:06.02f}')
 
 
+class SegmentFootprint:
+    """
+    Outline and front line of the segment a factory makes for one lane
+    configuration, relative to the pose the segment is placed with. Placing
+    them by the pose of a dead end gives the exact absolute geometry the
+    segment would have if it were attached there, without building it.
+    """
+
+    def __init__(self, segment):
+        self.outline = segment.get_rel_outline()
+        self.outline.flags.writeable = False
+        self.front = segment.get_rel_front()
+        self.front.flags.writeable = False
+
+    def place(self, turtle):
+        """
+        Returns the absolute outline and front line coordinates of the
+        segment when placed with the given turtle state.
+        """
+        matrix = turtle.get_transform()
+        outline = transform_coords(self.outline, matrix)
+        front = transform_coords(self.front, matrix)
+        return outline, front
+
+
+def get_segment_footprint(key, parent):
+    """
+    Returns the footprint of the segment the factory of the given key would
+    attach to the given parent. Footprints only depend on the factory and
+    the lane configuration, so each is taken from a throwaway segment once
+    and cached.
+    """
+    footprint_key = (key, len(parent.l_lanes), len(parent.r_lanes),
+                     c.ev.lane_width, c.ev.max_angle)
+    ret = SEG_FOOTPRINTS.get(footprint_key, None)
+    if ret is None:
+        segment = SEG_FACTORIES[key](0, parent)[0]
+        ret = SegmentFootprint(segment)
+        SEG_FOOTPRINTS[footprint_key] = ret
+    return ret
+
+
 def seg_combination_count(window):
     options = len(SEG_FACTORIES.keys())
     options = (options ** window) * (2 ** (window - 1))
@@ -322,6 +741,9 @@ generate_factories()
 
 
 class Prop:
+    __slots__ = ('proptype', 'x_off', 'y_off', 'angle', 'abs_x_off',
+                 'abs_y_off', 'abs_angle')
+
     @staticmethod
     def to_dict(prop):
         ret = dict()
@@ -373,38 +795,41 @@ class Prop:
 
 
 class Lane:
+    __slots__ = ('lane_id', 'edges', 'abs_edges', 'index', '_l_edge',
+                 '_r_edge', '_abs_l_edge', '_abs_r_edge', '_abs_polygon')
+
     @staticmethod
     def to_dict(lane):
         ret = dict()
         ret['lane_id'] = lane.lane_id
-
-        l_edge = []
-        for coord in lane.l_edge.coords:
-            l_edge.append([coord[0], coord[1]])
-        ret['l_edge'] = l_edge
-
-        r_edge = []
-        for coord in lane.r_edge.coords:
-            r_edge.append([coord[0], coord[1]])
-        ret['r_edge'] = r_edge
-
+        ret['l_edge'] = lane.l_coords.tolist()
+        ret['r_edge'] = lane.r_coords.tolist()
         return ret
 
     @staticmethod
     def from_dict(lane_dict):
         lane_id = lane_dict['lane_id']
-        l_edge = LineString([*lane_dict['l_edge']])
-        r_edge = LineString([*lane_dict['r_edge']])
-        return Lane(lane_id, l_edge, r_edge)
+        return Lane(lane_id, lane_dict['l_edge'], lane_dict['r_edge'])
 
-    def __init__(self, lane_id, l_edge, r_edge):
+    def __init__(self, lane_id, l_edge=None, r_edge=None):
         self.lane_id = lane_id
 
-        self.l_edge = l_edge
-        self.r_edge = r_edge
-        self.abs_l_edge = None
-        self.abs_r_edge = None
-        self.abs_polygon = None
+        # The left and right edge of this lane are the (n, 2) coordinate
+        # arrays at index and index + 1 of edges, which usually is the edge
+        # buffer of the node the lane belongs to. Lanes created on their own
+        # keep a list of just their two edges. The shapely views below are
+        # only built when something asks for them.
+        self.edges = None
+        self.abs_edges = None
+        self.index = 0
+        if l_edge is not None:
+            self.edges = [to_coords(l_edge), to_coords(r_edge)]
+
+        self._l_edge = None
+        self._r_edge = None
+        self._abs_l_edge = None
+        self._abs_r_edge = None
+        self._abs_polygon = None
 
     def __copy__(self):
         return self.copy()
@@ -412,44 +837,139 @@ class Lane:
     def __deepcopy__(self, memodict={}):
         return self.copy()
 
-    def copy(self):
-        return Lane(self.lane_id, LineString(self.l_edge),
-                    LineString(self.r_edge))
+    def __getstate__(self):
+        # Shapely views of the coordinates are rebuilt on demand, so only
+        # the coordinates themselves are pickled
+        state = {slot: getattr(self, slot) for slot in Lane.__slots__}
+        for slot in ('_l_edge', '_r_edge', '_abs_l_edge', '_abs_r_edge',
+                     '_abs_polygon'):
+            state[slot] = None
+        return state
 
-    def update_polygon(self):
-        l_poly = list(reversed(self.abs_l_edge.coords))
-        r_poly = list(self.abs_r_edge.coords)
-        self.abs_polygon = Polygon(l_poly + r_poly)
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
 
-    def update_abs_edges(self, turtle):
-        x = turtle.pos[0]
-        y = turtle.pos[1]
-        angle = turtle.angle
-        pivot = (0, 0)
+    def copy(self):
+        ret = Lane(self.lane_id)
+        if isinstance(self.edges, list):
+            ret.edges = [share_coords(edge) for edge in self.edges]
+        else:
+            ret.set_buffer(self.edges, self.index)
+        return ret
 
-        self.abs_l_edge = affinity.rotate(self.l_edge, angle, origin=pivot)
-        self.abs_l_edge = affinity.translate(self.abs_l_edge, xoff=x, yoff=y)
+    def set_buffer(self, edges, index):
+        self.edges = edges
+        self.index = index
+        self._l_edge = None
+        self._r_edge = None
+
+    def set_abs_buffer(self, abs_edges):
+        self.abs_edges = abs_edges
+        self._abs_l_edge = None
+        self._abs_r_edge = None
+        self._abs_polygon = None
+
+    def detach(self):
+        # Gives the lane its own list of edges, leaving the node buffer as is
+        if self.index or not isinstance(self.edges, list):
+            self.edges = [self.l_coords, self.r_coords]
+            if self.abs_edges is not None:
+                self.abs_edges = [self.abs_l_coords, self.abs_r_coords]
+            self.index = 0
+
+    @property
+    def l_coords(self):
+        return self.edges[self.index]
+
+    @property
+    def r_coords(self):
+        return self.edges[self.index + 1]
+
+    @property
+    def abs_l_coords(self):
+        if self.abs_edges is None:
+            return None
+        return self.abs_edges[self.index]
+
+    @property
+    def abs_r_coords(self):
+        if self.abs_edges is None:
+            return None
+        return self.abs_edges[self.index + 1]
+
+    @property
+    def l_edge(self):
+        if self._l_edge is None:
+            self._l_edge = LineString(self.l_coords)
+        return self._l_edge
+
+    @l_edge.setter
+    def l_edge(self, edge):
+        self.detach()
+        self.edges[0] = to_coords(edge)
+        self._l_edge = None
+
+    @property
+    def r_edge(self):
+        if self._r_edge is None:
+            self._r_edge = LineString(self.r_coords)
+        return self._r_edge
+
+    @r_edge.setter
+    def r_edge(self, edge):
+        self.detach()
+        self.edges[1] = to_coords(edge)
+        self._r_edge = None
+
+    @property
+    def abs_l_edge(self):
+        if self._abs_l_edge is None and self.abs_edges is not None:
+            self._abs_l_edge = LineString(self.abs_l_coords)
+        return self._abs_l_edge
+
+    @property
+    def abs_r_edge(self):
+        if self._abs_r_edge is None and self.abs_edges is not None:
+            self._abs_r_edge = LineString(self.abs_r_coords)
+        return self._abs_r_edge
+
+    @property
+    def abs_polygon(self):
+        if self._abs_polygon is None and self.abs_edges is not None:
+            self.update_polygon()
+        return self._abs_polygon
 
-        self.abs_r_edge = affinity.rotate(self.r_edge, angle, origin=pivot)
-        self.abs_r_edge = affinity.translate(self.abs_r_edge, xoff=x, yoff=y)
+    def update_polygon(self):
+        l_poly = self.abs_l_coords[::-1].tolist()
+        r_poly = self.abs_r_coords.tolist()
+        self._abs_polygon = Polygon(l_poly + r_poly)
 
-        self.update_polygon()
-        self.dirty = False
+    def set_abs_coords(self, abs_l_coords, abs_r_coords):
+        self.detach()
+        self.set_abs_buffer([abs_l_coords, abs_r_coords])
+
+    def update_abs_edges(self, turtle):
+        matrix = turtle.get_transform()
+        self.set_abs_coords(transform_coords(self.l_coords, matrix),
+                            transform_coords(self.r_coords, matrix))
 
     def get_edge_difference(self, own_edge, oth_edge):
-        diff = 0.0
-        for own_coord, oth_coord in zip(own_edge.coords, oth_edge.coords):
-            coord_diff = Point(*own_coord).distance(Point(*oth_coord))
-            diff += coord_diff
-        return diff
+        return get_coord_difference(to_coords(own_edge), to_coords(oth_edge))
 
     def get_difference(self, other):
-        diff = self.get_edge_difference(self.l_edge, other.l_edge)
-        diff += self.get_edge_difference(self.r_edge, other.r_edge)
+        diff = get_coord_difference(self.l_coords, other.l_coords)
+        diff += get_coord_difference(self.r_coords, other.r_coords)
         return diff
 
 
 class NetworkNode:
+    __slots__ = ('seg_id', 'roadtype', 'key', 'x_off', 'y_off', 'x_piv',
+                 'y_piv', 'length', 'angle', 'pivot_off', 'pivot_angle',
+                 'options', '_l_lanes', '_r_lanes', 'l_props', 'r_props',
+                 'root', 'dead', 'abs_pose', 'edges', 'abs_edges',
+                 '_abs_polygon', 'derived', 'owner', 'left_slots',
+                 'right_slots')
 
     @staticmethod
     def to_dict(node):
@@ -506,6 +1026,7 @@ class NetworkNode:
         node.r_lanes = r_lanes
         node.l_props = l_props
         node.r_props = r_props
+        node.pack_edges()
 
         return node
 
@@ -525,8 +1046,14 @@ class NetworkNode:
 
         self.options = options
 
-        self.l_lanes = []
-        self.r_lanes = []
+        # Relative and absolute coordinates of all lane edges of this node as
+        # (edges, vertices, 2) arrays, edges ordered from left to right. The
+        # coordinates of the lanes are views into these.
+        self.edges = None
+        self.abs_edges = None
+
+        self._l_lanes = []
+        self._r_lanes = []
 
         self.l_props = []
         self.r_props = []
@@ -534,10 +1061,108 @@ class NetworkNode:
         self.root = False
         self.dead = False
 
-        self.rel_polygon = None
-        self.abs_polygon = None
+        # Turtle state this node was last materialised with, as given by
+        # Turtle.get_pose
+        self.abs_pose = None
+
+        self._abs_polygon = None
+
+        # Geometry derived from the absolute lane coordinates, built on
+        # demand and dropped whenever the node is materialised again
+        self.derived = None
+
+        # Key of the network allowed to change this node in place, see
+        # NetworkLayout.own_nodes
+        self.owner = None
+
+    @property
+    def abs_polygon(self):
+        if self._abs_polygon is None and self.is_materialised():
+            self.update_abs_polygon()
+        return self._abs_polygon
+
+    @property
+    def l_lanes(self):
+        return self._l_lanes
+
+    @l_lanes.setter
+    def l_lanes(self, lanes):
+        self._l_lanes = lanes
+        self.edges = None
+        self.abs_edges = None
+
+    @property
+    def r_lanes(self):
+        return self._r_lanes
+
+    @r_lanes.setter
+    def r_lanes(self, lanes):
+        self._r_lanes = lanes
+        self.edges = None
+        self.abs_edges = None
+
+    def __getstate__(self):
+        # Derived geometry includes prepared geometries, which can not be
+        # pickled, and is rebuilt on demand along with the polygon
+        state = {}
+        for slot in NetworkNode.__slots__:
+            if hasattr(self, slot):
+                state[slot] = getattr(self, slot)
+        state['_abs_polygon'] = None
+        state['derived'] = None
+        return state
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+        # Edge buffers come from shared templates and stay read-only, see
+        # share_coords
+        if self.edges is not None:
+            self.edges.flags.writeable = False
+
+    def get_ordered_lanes(self):
+        return list(reversed(self._l_lanes)) + self._r_lanes
+
+    def get_derived(self, key, builder):
+        if self.derived is None:
+            self.derived = {}
+        ret = self.derived.get(key, None)
+        if ret is None:
+            ret = builder()
+            if ret is not None:
+                self.derived[key] = ret
+        return ret
+
+    def get_prepared_polygon(self):
+        return self.get_derived('prepared', lambda: prep(self.abs_polygon))
+
+    def get_abs_bounds(self):
+        """
+        Returns the (minx, miny, maxx, maxy) bounds of the absolute polygon of
+        this node, computed from the coordinates of its outer edges instead
+        of the polygon itself.
+        """
+        return self.get_derived('bounds', self.build_abs_bounds)
+
+    def build_abs_bounds(self):
+        if not self.is_materialised():
+            return None
+        coords = np.concatenate((self.get_left_coords(),
+                                 self.get_right_coords()))
+        mins = coords.min(axis=0)
+        maxs = coords.max(axis=0)
+        return float(mins[0]), float(mins[1]), float(maxs[0]), float(maxs[1])
+
+    def is_materialised(self):
+        lanes = self.l_lanes or self.r_lanes
+        if not lanes:
+            return False
+        return lanes[0].abs_edges is not None
 
     def get_spine(self):
+        return self.get_derived('spine', self.build_spine)
+
+    def build_spine(self):
         if len(self.r_lanes) > 0:
             spine = self.r_lanes[0]
             spine = spine.abs_l_edge
@@ -546,13 +1171,42 @@ class NetworkNode:
             spine = spine.abs_r_edge
         return spine
 
+    def get_cross_sections(self):
+        """
+        Returns the absolute coordinates of all lane edges of this node as
+        an array of shape (vertices, edges, 2). Entry [i, j] is the i-th
+        vertex of the j-th edge, edges ordered from left to right.
+        """
+        return self.get_derived('sections', self.build_cross_sections)
+
+    def build_cross_sections(self):
+        if self.abs_edges is not None and self.has_buffer():
+            return self.abs_edges.transpose(1, 0, 2)
+
+        lanes = self.get_ordered_lanes()
+        edges = [lane.abs_l_coords for lane in lanes]
+        edges.append(lanes[-1].abs_r_coords)
+        return np.stack(edges, axis=1)
+
+    def get_widths(self):
+        """
+        Returns the width of the road at each vertex of the spine, i.e. the
+        length of the cross-section line through all lane edges.
+        """
+        return self.get_derived('widths', self.build_widths)
+
+    def build_widths(self):
+        sections = self.get_cross_sections()
+        steps = np.diff(sections, axis=1)
+        steps = np.sqrt(steps[:, :, 0] * steps[:, :, 0] +
+                        steps[:, :, 1] * steps[:, :, 1])
+        return steps.sum(axis=1)
+
     def get_line(self, index):
-        lanes = list(reversed(self.l_lanes)) + self.r_lanes
-        points = []
-        for lane in lanes:
-            points.append(lane.abs_l_edge.coords[index])
-        points.append(lanes[-1].abs_r_edge.coords[index])
-        return LineString(points)
+        sections = self.get_cross_sections()
+        index = index % len(sections)
+        key = ('line', index)
+        return self.get_derived(key, lambda: LineString(sections[index]))
 
     def get_front_line(self):
         return self.get_line(-1)
@@ -567,28 +1221,59 @@ class NetworkNode:
 
     def manifest_lanes(self, lines, l_lane_c, r_lane_c):
         assert lines
-        edges = [[] for point in lines[0].coords]
-        for line in lines:
-            for idx, coord in enumerate(line.coords):
-                edges[idx].append(coord)
-
-        lane_id = 1
-        self.l_lanes = []
-        for i in range(0, l_lane_c):
-            l_edge = LineString(edges.pop(0))
-            r_edge = LineString(edges[0])
-            lane = Lane(lane_id, l_edge, r_edge)
-            lane_id += 1
-            self.l_lanes.append(lane)
-        self.l_lanes = list(reversed(self.l_lanes))
-
-        self.r_lanes = []
-        for i in range(0, r_lane_c):
-            l_edge = LineString(edges.pop(0))
-            r_edge = LineString(edges[0])
-            lane = Lane(lane_id, l_edge, r_edge)
-            lane_id += 1
-            self.r_lanes.append(lane)
+        self.manifest_edges(lines_to_edges(lines), l_lane_c, r_lane_c)
+
+    def manifest_edges(self, edges, l_lane_c, r_lane_c):
+        assert len(edges) == l_lane_c + r_lane_c + 1
+        edges = np.asarray(edges, dtype=np.float64)
+        if edges.flags.writeable:
+            edges = edges.copy()
+            edges.flags.writeable = False
+
+        lanes = []
+        for idx in range(l_lane_c + r_lane_c):
+            lane = Lane(idx + 1)
+            lane.set_buffer(edges, idx)
+            lanes.append(lane)
+
+        self.l_lanes = list(reversed(lanes[:l_lane_c]))
+        self.r_lanes = lanes[l_lane_c:]
+        self.edges = edges
+
+    def pack_edges(self):
+        """
+        Moves the relative lane coordinates of this node into one shared
+        edge buffer, provided neighbouring lanes share their edges as they
+        do for every node built by the segment factories.
+        """
+        lanes = self.get_ordered_lanes()
+        if not lanes:
+            return
+
+        coords = [lane.l_coords for lane in lanes]
+        coords.append(lanes[-1].r_coords)
+        if len({len(edge) for edge in coords}) > 1:
+            return
+        for lane, neighbour in zip(lanes, lanes[1:]):
+            if not np.array_equal(lane.r_coords, neighbour.l_coords):
+                return
+
+        edges = np.stack(coords)
+        edges.flags.writeable = False
+        for idx, lane in enumerate(lanes):
+            lane.set_buffer(edges, idx)
+        self.edges = edges
+
+    def has_buffer(self):
+        if self.edges is None:
+            return False
+        for lane in self._l_lanes:
+            if lane.edges is not self.edges:
+                return False
+        for lane in self._r_lanes:
+            if lane.edges is not self.edges:
+                return False
+        return True
 
     def __copy__(self):
         return self.copy()
@@ -607,6 +1292,8 @@ class NetworkNode:
 
         self_copy = NetworkNode(seg_id, self.roadtype,
                                 self.key, **self.options)
+        # Options are never changed after construction and can be shared
+        self_copy.options = self.options
 
         self_copy.x_off = self.x_off
         self_copy.y_off = self.y_off
@@ -620,10 +1307,17 @@ class NetworkNode:
         self_copy.r_lanes = r_lanes
         self_copy.l_props = l_props
         self_copy.r_props = r_props
+        # The lanes copied above still view the same read-only buffer
+        self_copy.edges = self.edges
 
         return self_copy
 
     def get_left_edge(self, abs=True):
+        if abs:
+            return self.get_derived('left', lambda: self.build_left_edge(abs))
+        return self.build_left_edge(abs)
+
+    def build_left_edge(self, abs):
         if self.l_lanes:
             lane = self.l_lanes[-1]
         else:
@@ -637,6 +1331,11 @@ class NetworkNode:
         return l_most
 
     def get_right_edge(self, abs=True):
+        if abs:
+            return self.get_derived('right', lambda: self.build_right_edge(abs))
+        return self.build_right_edge(abs)
+
+    def build_right_edge(self, abs):
         if self.r_lanes:
             lane = self.r_lanes[-1]
         else:
@@ -649,21 +1348,53 @@ class NetworkNode:
 
         return r_most
 
+    def get_left_coords(self):
+        if self.l_lanes:
+            return self.l_lanes[-1].abs_l_coords
+        return self.r_lanes[0].abs_l_coords
+
+    def get_right_coords(self):
+        if self.r_lanes:
+            return self.r_lanes[-1].abs_r_coords
+        return self.l_lanes[0].abs_r_coords
+
+    def get_rel_outline(self):
+        """
+        Returns the relative coordinates of the outline of this node, in the
+        order update_polygon builds its absolute polygon from.
+        """
+        if self.l_lanes:
+            l_most = self.l_lanes[-1].l_coords
+        else:
+            l_most = self.r_lanes[0].l_coords
+        if self.r_lanes:
+            r_most = self.r_lanes[-1].r_coords
+        else:
+            r_most = self.l_lanes[0].r_coords
+        return np.concatenate((l_most[::-1], r_most))
+
+    def get_rel_front(self):
+        """
+        Returns the relative coordinates of the last vertex of every lane
+        edge of this node, from left to right, which make up its front line.
+        """
+        lanes = self.get_ordered_lanes()
+        coords = [lane.l_coords[-1] for lane in lanes]
+        coords.append(lanes[-1].r_coords[-1])
+        return np.stack(coords)
+
     def update_polygon(self):
         if not self.l_lanes and not self.r_lanes:
             return
 
-        l_most = self.get_left_edge()
-        r_most = self.get_right_edge()
-
-        l_most = list(reversed(l_most.coords))
-        r_most = list(r_most.coords)
+        l_most = self.get_left_coords()[::-1].tolist()
+        r_most = self.get_right_coords().tolist()
         return Polygon(l_most + r_most)
 
     def update_abs_polygon(self):
         polygon = self.update_polygon()
-        self.abs_polygon = polygon
-        return self.abs_polygon
+        self._abs_polygon = polygon
+        return self._abs_polygon
 
     def update_abs_slots(self, slots, turtle):
         x = turtle.pos[0]
@@ -678,24 +1409,97 @@ class NetworkNode:
             abs_slots.append(abs_slot)
         return abs_slots
 
+    def get_rel_coords(self):
+        """
+        Returns the relative coordinates of all lane edges of this node as
+        one stacked (n, 2) array, in the order expected by set_abs_coords.
+        For nodes with an edge buffer this is a view of the buffer, otherwise
+        the left and right edge of each lane in turn.
+        """
+        if self.has_buffer():
+            return self.edges.reshape(-1, 2)
+
+        coords = []
+        for lane in self.l_lanes + self.r_lanes:
+            coords.append(lane.l_coords)
+            coords.append(lane.r_coords)
+        return np.concatenate(coords)
+
+    def set_abs_coords(self, abs_coords):
+        if self.has_buffer():
+            self.abs_edges = abs_coords.reshape(self.edges.shape)
+            for lane in self.get_ordered_lanes():
+                lane.set_abs_buffer(self.abs_edges)
+        else:
+            self.abs_edges = None
+            offset = 0
+            for lane in self.l_lanes + self.r_lanes:
+                l_end = offset + len(lane.l_coords)
+                r_end = l_end + len(lane.r_coords)
+                lane.set_abs_coords(abs_coords[offset:l_end],
+                                    abs_coords[l_end:r_end])
+                offset = r_end
+        self._abs_polygon = None
+        self.derived = None
+
+    def set_abs_from(self, other):
+        """
+        Takes over the absolute geometry of the given copy of this node. The
+        coordinate arrays are never changed in place, so they are shared.
+        """
+        self.abs_pose = other.abs_pose
+        self.abs_edges = other.abs_edges
+        own_lanes = self.get_ordered_lanes()
+        oth_lanes = other.get_ordered_lanes()
+        for own_lane, oth_lane in zip(own_lanes, oth_lanes):
+            own_lane.set_abs_buffer(oth_lane.abs_edges)
+        self._abs_polygon = other._abs_polygon
+        if other.derived:
+            self.derived = {**other.derived}
+
     def update_abs(self, turtle):
+        self.abs_pose = turtle.get_pose()
         if self.roadtype not in GHOST_TYPES:
-            for lane in self.l_lanes + self.r_lanes:
-                lane.update_abs_edges(turtle)
+            matrix = turtle.get_transform()
+            abs_coords = transform_coords(self.get_rel_coords(), matrix)
+            self.set_abs_coords(abs_coords)
 
             # self.abs_l_slots = self.update_abs_slots(self.l_slots, turtle)
             # self.abs_r_slots = self.update_abs_slots(self.r_slots, turtle)
 
-            self.update_abs_polygon()
-
-    def get_difference(self, other):
-        diff = 0.0
+    def get_vertex_count(self):
+        ret = 0
+        for lane in self.l_lanes + self.r_lanes:
+            ret = max(ret, len(lane.l_coords), len(lane.r_coords))
+        return ret
 
+    def get_lane_coords(self, lanes=None, vertices=None):
+        """
+        Returns the relative coordinates of the left and right edge of every
+        lane of this node, in l_lanes + r_lanes order, as one (lanes, 2,
+        vertices, 2) array. Lanes and vertices default to what this node
+        has. Edges with fewer vertices and missing lanes are padded with NaN,
+        anything beyond the given counts is cut off.
+        """
         own_lanes = self.l_lanes + self.r_lanes
-        oth_lanes = other.l_lanes + other.r_lanes
+        if lanes is None:
+            lanes = len(own_lanes)
+        if vertices is None:
+            vertices = self.get_vertex_count()
+
+        ret = np.full((lanes, 2, vertices, 2), np.nan)
+        for idx, lane in enumerate(own_lanes[:lanes]):
+            l_coords = lane.l_coords[:vertices]
+            r_coords = lane.r_coords[:vertices]
+            ret[idx, 0, :len(l_coords)] = l_coords
+            ret[idx, 1, :len(r_coords)] = r_coords
+        return ret
 
-        for own_lane, oth_lane in zip(own_lanes, oth_lanes):
-            diff += own_lane.get_difference(oth_lane)
+    def get_difference(self, other):
+        own_coords = self.get_lane_coords()
+        oth_coords = other.get_lane_coords()
+        lanes = min(len(own_coords), len(oth_coords))
+        diff = get_coord_difference(own_coords[:lanes], oth_coords[:lanes])
 
         diff += math.fabs(len(self.l_lanes) - len(other.l_lanes))
         diff += math.fabs(len(self.r_lanes) - len(other.r_lanes))
@@ -715,6 +1519,65 @@ class NetworkNode:
         return '({}, {})'.format(self.seg_id, self.key)
 
 
+class IntersectionTable:
+    """
+    Intersecting segment pairs of a layout at one geometry version. For every
+    segment, the table lists the segments its polygon intersects in the order
+    the spatial index returns them, leaving out the segment itself and its
+    direct parent and children. The intersection of the spines of each such
+    pair is kept alongside, giving the type of the intersection and, for
+    proper crossings, the point the two segments cross at.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.intersecting = {}
+        self.spines = {}
+
+    def get_intersecting(self, node):
+        return self.intersecting.get(node, [])
+
+    def get_spine_intersection(self, anode, bnode):
+        return self.spines.get(frozenset((anode, bnode)), None)
+
+    def has_intersections(self):
+        for intersecting in self.intersecting.values():
+            if intersecting:
+                return True
+        return False
+
+
+class ReachabilityClosure:
+    """
+    Transitive closure of a reachability graph. Nodes are grouped into their
+    strongly connected components and every component keeps the components
+    reachable from it in the condensed, acyclic graph as a bitset, so asking
+    if one node is reachable from another is two lookups and a bit test.
+    """
+
+    def __init__(self, graph):
+        self.component = {}
+        components = list(strongly_connected_components(graph))
+        for idx, component in enumerate(components):
+            for node in component:
+                self.component[node] = idx
+
+        condensed = networkx.condensation(graph, scc=components)
+        self.reach = [0] * len(components)
+        # Successors come after their predecessors in topological order, so
+        # walking it backwards sees every successor's bitset complete
+        for idx in reversed(list(topological_sort(condensed))):
+            bits = 1 << idx
+            for succ in condensed.successors(idx):
+                bits |= self.reach[succ]
+            self.reach[idx] = bits
+
+    def is_reachable(self, from_node, to_node):
+        from_idx = self.component[from_node]
+        to_idx = self.component[to_node]
+        return bool(self.reach[from_idx] >> to_idx & 1)
+
+
 class NetworkLayout:
 
     @staticmethod
@@ -755,6 +1618,9 @@ class NetworkLayout:
         nodes = {}
         for _, node_dict in nodes_dict.items():
             nodes[int(node_dict['seg_id'])] = NetworkNode.from_dict(node_dict)
+        # Segments added to the loaded layout need IDs of their own
+        if nodes:
+            layout.seg_id = max(nodes) + 1
 
         parentage = dict['parentage']
         for edge in parentage:
@@ -776,14 +1642,43 @@ class NetworkLayout:
     def __init__(self, bounds):
         self.bounds = bounds
         self.reachability = networkx.DiGraph()
-        self.parentage = networkx.DiGraph()
+        self.parentage = Parentage()
         self.nodes = {}
         self.spindex = None
+        self.spindex_boxes = {}
 
         self.inters = list()
+        self.intersections = None
+        self.closure = None
+        self.fingerprint = None
+        self.check_stats = CheckStats()
+        # Version stamped set of segments crossing the border of the bounds
+        self.boundary = None
+        self.bounds_box = None
+        self.bounds_prep = None
 
         self.seg_id = 1
-        self.absolute_version = -1
+        # Incremented whenever the structure or absolute geometry of the
+        # network changes, used to tell if derived data is still valid.
+        self.version = 0
+
+        # Copies of a network share its nodes, parentage graph and spatial
+        # index. Nodes are only changed in place by the network whose owner
+        # key they carry and shared structures are copied before they are
+        # first modified.
+        self.owner_key = object()
+        self.parentage_shared = False
+        self.spindex_shared = False
+        # Nodes whose absolute geometry is outdated. If a node is dirty, all
+        # of its descendants are as well.
+        self.dirty = set()
+
+    def __getstate__(self):
+        # Prepared geometries can not be pickled, the prepared bounds are
+        # rebuilt on demand
+        state = self.__dict__.copy()
+        state['bounds_prep'] = None
+        return state
 
     def get_roadtype_distribution(self):
         ret = {}
@@ -824,29 +1719,114 @@ class NetworkLayout:
         return ret
 
     def add_node(self, node):
+        self.unshare()
+        self.claim(node)
         self.parentage.add_node(node)
         self.reachability.add_node(node)
+        self.closure = None
+        self.fingerprint = None
         self.nodes[node.seg_id] = node
+        self.mark_dirty(node)
 
     def add_parentage(self, parent, child):
         assert isinstance(parent, NetworkNode)
         assert isinstance(child, NetworkNode)
+        self.unshare()
+        if parent not in self.parentage:
+            self.claim(parent)
+            self.mark_dirty(parent)
+        self.claim(child)
         self.parentage.add_edge(parent, child)
         self.add_reachable(parent, child)
         self.nodes[parent.seg_id] = parent
         self.nodes[child.seg_id] = child
+        self.mark_dirty(child)
 
     def add_reachable(self, from_node, to_node):
         self.reachability.add_edge(from_node, to_node, direction=True)
         self.reachability.add_edge(to_node, from_node, direction=False)
+        self.closure = None
+        self.fingerprint = None
         self.nodes[from_node.seg_id] = from_node
         self.nodes[to_node.seg_id] = to_node
 
     def remove_node(self, node):
+        for child in self.get_children(node):
+            self.mark_dirty(child)
+        self.unindex_node(node)
+        self.dirty.discard(node)
+        self.version += 1
+        self.unshare()
         self.parentage.remove_node(node)
         self.reachability.remove_node(node)
+        self.closure = None
+        self.fingerprint = None
         del self.nodes[node.seg_id]
 
+    def unshare(self):
+        if self.parentage_shared:
+            self.parentage = self.parentage.copy()
+            self.parentage_shared = False
+
+    def unshare_spindex(self):
+        if self.spindex_shared:
+            entries = list(self.spindex_boxes.items())
+            self.spindex = create_index(self.bounds.bounds, entries)
+            self.spindex_shared = False
+
+    def claim(self, node):
+        if node.owner is None:
+            node.owner = self.owner_key
+
+    def own_nodes(self, nodes):
+        """
+        Makes sure the given nodes can be changed in place by this network.
+        Nodes it does not own are shared with copies of this network and get
+        replaced by copies of their own, keeping their absolute geometry.
+        """
+        mapping = {}
+        for node in nodes:
+            if node.owner is not self.owner_key:
+                replacement = node.copy()
+                replacement.owner = self.owner_key
+                replacement.dead = node.dead
+                replacement.set_abs_from(node)
+                mapping[node] = replacement
+
+        if not mapping:
+            return
+
+        # Nodes compare equal to their copies, so the graphs have to be
+        # relabeled to actually hold the new objects
+        self.parentage = self.parentage.relabeled(mapping)
+        self.boundary = None
+        self.fingerprint = None
+        self.parentage_shared = False
+        self.reachability = networkx.relabel_nodes(self.reachability, mapping)
+        self.unshare_spindex()
+        for node, replacement in mapping.items():
+            self.nodes[node.seg_id] = replacement
+            seg_box = self.spindex_boxes.pop(node, None)
+            if seg_box:
+                self.spindex.remove(node, seg_box)
+                self.spindex.insert(replacement, seg_box)
+                self.spindex_boxes[replacement] = seg_box
+
+        self.dirty = {mapping.get(node, node) for node in self.dirty}
+        self.inters = [(mapping.get(a_inter, a_inter),
+                        mapping.get(b_inter, b_inter))
+                       for a_inter, b_inter in self.inters]
+
+    def mark_dirty(self, node):
+        todo = [node]
+        while todo:
+            node = todo.pop()
+            if node in self.dirty:
+                continue
+            self.dirty.add(node)
+            if node in self.parentage:
+                todo.extend(self.parentage.successors(node))
+
     def find_roots(self):
         ret = set()
         for node in self.parentage.nodes():
@@ -854,35 +1834,142 @@ class NetworkLayout:
                 ret.add(node)
         return ret
 
-    def materialise_from(self, root):
-        turtle = Turtle()
+    def materialise_from(self, root, turtle=None):
+        # Walk the chain once to collect the turtle transform of every node,
+        # then transform the relative lane coordinates of all of them in a
+        # single batch instead of segment by segment.
+        if not turtle:
+            turtle = Turtle()
+        visited = []
+        nodes = []
+        matrices = []
+        coords = []
+        index = []
 
         todo = [root]
         while todo:
             todo_node = todo.pop(0)
-            todo_node.update_abs(turtle)
+            todo_node.abs_pose = turtle.get_pose()
+            visited.append(todo_node)
+            if todo_node.roadtype not in GHOST_TYPES:
+                rel_coords = todo_node.get_rel_coords()
+                index.append(np.full(len(rel_coords), len(matrices)))
+                nodes.append(todo_node)
+                matrices.append(turtle.get_transform())
+                coords.append(rel_coords)
             todo.extend([*self.parentage.successors(todo_node)])
             turtle.move(todo_node)
 
+        if nodes:
+            abs_coords = transform_coords(np.concatenate(coords),
+                                          np.stack(matrices),
+                                          np.concatenate(index))
+            # Every node gets its own copy of its part of the batch, otherwise
+            # the whole batch is kept alive as long as any node refers to it
+            offset = 0
+            for node, rel_coords in zip(nodes, coords):
+                end = offset + len(rel_coords)
+                node.set_abs_coords(abs_coords[offset:end].copy())
+                offset = end
+
+        return visited
+
+    def get_entry_turtle(self, node):
+        """
+        Returns the turtle state the given node is placed with, derived from
+        its parent's pose, or None if the node is detached from any root.
+        """
+        if node.roadtype == TYPE_ROOT:
+            return Turtle()
+
+        parent = self.get_parent(node)
+        if not parent:
+            return None
+        return self.get_exit_turtle(parent)
+
+    def get_exit_turtle(self, node):
+        """
+        Returns the turtle state children of the given node are placed with,
+        or None if the node has not been materialised or is outdated.
+        """
+        if node.abs_pose is None or node in self.dirty:
+            return None
+
+        turtle = Turtle.from_pose(node.abs_pose)
+        turtle.move(node)
+        return turtle
+
+    def is_extension_blocked(self, parent, outline):
+        """
+        Tells if attaching a segment with the given absolute outline to the
+        given dead end would certainly make the network inconsistent,
+        because the segment would overlap another segment of its own branch.
+        The outline is only tested against the segments the spatial index
+        finds around it.
+        """
+        if self.spindex is None or self.dirty:
+            return False
+        root = self.get_root_from(parent)
+        if root.roadtype != TYPE_ROOT:
+            return False
+
+        bbox = (outline[:, 0].min(), outline[:, 1].min(),
+                outline[:, 0].max(), outline[:, 1].max())
+        # Only segments within the bounds are indexed
+        bounds_box = self.get_bounds_box()
+        if bounds_box and classify_box(bbox, bounds_box) == BOUNDS_OUTSIDE:
+            return False
+
+        polygon = None
+        for other in self.spindex.intersect(bbox):
+            if other == parent or other.roadtype in GHOST_TYPES:
+                continue
+            if self.get_root_from(other) != root:
+                continue
+            if polygon is None:
+                polygon = Polygon(outline.tolist())
+            if other.get_prepared_polygon().intersects(polygon):
+                return True
+        return False
+
     def update_abs(self, force=False):
-        if not force and self.absolute_version == self.seg_id:
+        rebuild = force or self.spindex is None
+        if force:
+            self.dirty.update(self.parentage.nodes())
+
+        if not self.dirty and not rebuild:
             return
 
-        roots = self.find_roots()
-        for root in roots:
-            self.materialise_from(root)
+        self.own_nodes(self.dirty)
+
+        # Only the topmost dirty node of each chain needs to be walked from,
+        # the remaining dirty nodes are its descendants.
+        tops = [node for node in self.dirty
+                if self.get_parent(node) not in self.dirty]
 
-        self.absolute_version = self.seg_id
-        self.spindex = self.build_qtree()
+        materialised = []
+        for top in tops:
+            turtle = self.get_entry_turtle(top)
+            if turtle:
+                materialised.extend(self.materialise_from(top, turtle))
+
+        self.dirty = set()
+        self.version += 1
+        if rebuild:
+            self.spindex = self.build_spindex()
+            self.spindex_shared = False
+        else:
+            for node in materialised:
+                self.unindex_node(node)
+                self.index_node(node)
 
     def prune_oob(self):
-        boundary_prep = prep(self.bounds)
         boundary_nodes = self.get_boundary_intersecting_nodes()
         for boundary_node in boundary_nodes:
             if boundary_node in self.parentage.nodes():
                 children = self.get_children(boundary_node)
                 for child in children:
-                    if boundary_prep.disjoint(child.abs_polygon):
+                    if not self.seg_in_bounds(child):
                         self.remove_after(boundary_node)
                         break
 
@@ -900,27 +1987,41 @@ class NetworkLayout:
         return ret
 
     def seal_dead_ends(self):
+        self.own_nodes(self.find_dead_ends())
         ends = self.find_dead_ends()
         for node in ends:
             node.dead = True
 
-    def build_qtree(self):
-        bounds_prep = prep(self.bounds)
-        bbox = []
-        for val in self.bounds.bounds:
-            bbox.append(val * 2)
-        #ret = Index(bbox=bbox, maxdepth=100000)
-        ret = Index(bbox=bbox)
+    def build_spindex(self):
+        self.spindex_boxes = {}
+        entries = []
         for segment in self.parentage.nodes():
             if segment.abs_polygon:
-                seg_poly = segment.abs_polygon
-                if not bounds_prep.disjoint(seg_poly):
-                    ret.insert(segment, segment.abs_polygon.bounds)
-        return ret
+                if self.seg_in_bounds(segment):
+                    seg_box = segment.get_abs_bounds()
+                    entries.append((segment, seg_box))
+                    self.spindex_boxes[segment] = seg_box
+        return create_index(self.bounds.bounds, entries)
+
+    def index_node(self, segment):
+        seg_poly = segment.abs_polygon
+        if seg_poly and self.seg_in_bounds(segment):
+            seg_box = segment.get_abs_bounds()
+            self.unshare_spindex()
+            self.spindex.insert(segment, seg_box)
+            self.spindex_boxes[segment] = seg_box
+
+    def unindex_node(self, segment):
+        if segment not in self.spindex_boxes:
+            return
+        self.unshare_spindex()
+        seg_box = self.spindex_boxes.pop(segment)
+        self.spindex.remove(segment, seg_box)
 
-    def get_intersecting_nodes(self, polygon):
+    def get_intersecting_nodes(self, polygon, prepared=None):
         ret = list()
-        prepared = prep(polygon)
+        if not prepared:
+            prepared = prep(polygon)
         others = self.spindex.intersect(polygon.bounds)
         for other in others:
             if other.roadtype in GHOST_TYPES:
@@ -934,7 +2035,8 @@ class NetworkLayout:
 
     def get_segment_intersecting_nodes(self, node):
         ret = list()
-        intersecting = self.get_intersecting_nodes(node.abs_polygon)
+        intersecting = self.get_intersecting_nodes(
+            node.abs_polygon, node.get_prepared_polygon())
         for intersection in intersecting:
             if intersection == node:
                 continue
@@ -947,6 +2049,57 @@ class NetworkLayout:
 
         return ret
 
+    def get_intersections(self):
+        """
+        Returns the IntersectionTable of the current geometry of the network,
+        computing it only if the network changed since it was last requested.
+        """
+        self.update_abs()
+        if self.intersections and self.intersections.version == self.version:
+            return self.intersections
+
+        table = IntersectionTable(self.version)
+        tested = {}
+        for segment in self.parentage.nodes():
+            if segment.roadtype in GHOST_TYPES:
+                continue
+
+            assert segment.abs_polygon
+            prepared = segment.get_prepared_polygon()
+            intersecting = []
+            for other in self.spindex.intersect(segment.get_abs_bounds()):
+                if other == segment or other.roadtype in GHOST_TYPES:
+                    continue
+                if self.parentage.has_edge(segment, other):
+                    continue
+                if self.parentage.has_edge(other, segment):
+                    continue
+
+                # Polygon intersection is symmetric, so each pair only needs
+                # to be tested once
+                pair = frozenset((segment, other))
+                if pair not in tested:
+                    tested[pair] = prepared.intersects(other.abs_polygon)
+                if not tested[pair]:
+                    continue
+
+                intersecting.append(other)
+                if pair not in table.spines:
+                    own_spine = segment.get_spine()
+                    oth_spine = other.get_spine()
+                    table.spines[pair] = own_spine.intersection(oth_spine)
+
+            table.intersecting[segment] = intersecting
+
+        self.intersections = table
+        return table
+
+    def get_spine_intersection(self, anode, bnode):
+        ret = self.get_intersections().get_spine_intersection(anode, bnode)
+        if ret is None:
+            ret = anode.get_spine().intersection(bnode.get_spine())
+        return ret
+
     def get_nodes_at(self, point):
         ret = set()
         others = self.spindex.intersect(point.bounds)
@@ -960,34 +2113,19 @@ class NetworkLayout:
     def get_start_goal_candidates(self):
         boundary_nodes = self.get_boundary_intersecting_nodes()
         if len(boundary_nodes) > 1:
+            closure = self.get_reachability_closure()
             options = set()
             for left, right in itertools.combinations(boundary_nodes, 2):
-                if self.is_reachable(left, right):
+                if closure.is_reachable(left, right):
                     options.add((left, right))
-                if self.is_reachable(right, left):
+                if closure.is_reachable(right, left):
                     options.add((right, left))
             return options
 
         return []
 
     def is_self_intersecting(self):
-        for segment in self.parentage.nodes():
-            if segment.roadtype in GHOST_TYPES:
-                continue
-
-            assert segment.abs_polygon
-            poly_seg = segment.abs_polygon
-            intersecting = self.get_intersecting_nodes(poly_seg)
-            for other in intersecting:
-                if segment == other:
-                    continue
-                if self.parentage.has_edge(segment, other):
-                    continue
-                if self.parentage.has_edge(other, segment):
-                    continue
-
-                return True
-        return False
+        return self.get_intersections().has_intersections()
 
     def get_point_side(self, line, point):
         side = (point[0] - line.coords[0][0]) * \
@@ -1001,7 +2139,7 @@ class NetworkLayout:
             return 1
         return 0
 
-    def is_full_crossing(self, mom, dad):
+    def is_full_crossing(self, mom, dad, intersection=None):
         d_back = dad.get_back_line()
         d_front = dad.get_front_line()
 
@@ -1017,11 +2155,12 @@ class NetworkLayout:
         m_spine = mom.get_spine()
         d_spine = dad.get_spine()
 
-        if not m_spine.intersects(d_spine):
+        if intersection is None:
+            intersection = self.get_spine_intersection(mom, dad)
+        if intersection.is_empty:
             l.debug('Spines dont intersect')
             return False
 
-        intersection = m_spine.intersection(d_spine)
         if intersection.geom_type != 'Point':
             l.debug('Intersection is not a point.')
             return False
@@ -1055,23 +2194,20 @@ class NetworkLayout:
         return True
 
     def has_partial_overlaps(self):
+        table = self.get_intersections()
         for node in self.parentage.nodes():
             if node.roadtype in GHOST_TYPES:
                 continue
 
-            intersecting = self.get_segment_intersecting_nodes(node)
-            # intersecting = self.get_intersecting_nodes(node.abs_polygon)
+            intersecting = list(table.get_intersecting(node))
             if len(intersecting) > 1:
                 l.debug('Found %s intersecting nodes for %s', len(intersecting),
                         str(node))
                 return True
 
             if intersecting:
-                other = set(intersecting)
-                other = other.pop()
-                m_spine = node.get_spine()
-                d_spine = other.get_spine()
-                intersection = m_spine.intersection(d_spine)
+                other = intersecting[0]
+                intersection = table.get_spine_intersection(node, other)
                 if intersection.geom_type != 'Point':
                     return True
 
@@ -1088,19 +2224,33 @@ class NetworkLayout:
         return False
 
     def branch_self_intersects(self, root):
+        table = self.get_intersections()
         branch = self.get_branch_from(root)
         for segment in branch:
             if segment.roadtype in GHOST_TYPES:
                 continue
 
-            intersecting = self.get_segment_intersecting_nodes(segment)
+            intersecting = table.get_intersecting(segment)
             for intersection in intersecting:
                 if intersection in branch:
                     return True
 
         return False
 
+    def get_reachability_closure(self):
+        """
+        Returns the transitive closure of the reachability graph, computed
+        once and kept until the graph changes.
+        """
+        if self.closure is None:
+            self.closure = ReachabilityClosure(self.reachability)
+        return self.closure
+
     def is_reachable(self, from_node, to_node):
+        closure = self.get_reachability_closure()
+        if from_node in closure.component and to_node in closure.component:
+            return closure.is_reachable(from_node, to_node)
+        # Let networkx complain about nodes that are not in the graph
         ret = has_path(self.reachability, from_node, to_node)
         return ret
 
@@ -1113,6 +2263,15 @@ class NetworkLayout:
                                  cutoff=len(self.parentage.nodes()))
         return paths
 
+    def best_paths(self, from_node, to_node, weigh=weigh_count, k=None):
+        paths = best_paths(self.reachability, from_node, to_node, weigh=weigh,
+                           k=k)
+        return paths
+
+    def random_paths(self, from_node, to_node, rng, k=None):
+        paths = random_paths(self.reachability, from_node, to_node, rng, k=k)
+        return paths
+
     def all_shortest_paths(self, from_node, to_node):
         paths = all_shortest_paths(self.reachability, from_node, to_node)
         return paths
@@ -1128,10 +2287,7 @@ class NetworkLayout:
         return self.get_nodes(TYPE_ROOT)
 
     def get_parent(self, child):
-        incoming = self.parentage.in_edges(child)
-        for edge in incoming:
-            return edge[0]
-        return None
+        return self.parentage.get_parent(child)
 
     def get_children(self, parent):
         ret = set()
@@ -1142,59 +2298,156 @@ class NetworkLayout:
         return ret
 
     def get_root_from(self, node):
-        while node.roadtype != TYPE_ROOT:
-            node = self.get_parent(node)
-        return node
+        return self.parentage.get_root(node)
 
     def get_root_distance(self, node):
-        root = self.get_root_from(node)
-        return shortest_path_length(self.parentage, root, node)
+        return self.parentage.get_depth(node)
 
     def get_branch_from(self, node):
-        ret = [node]
-        while True:
-            children = self.get_children(ret[-1])
-            if len(children) == 1:
-                ret.append(children.pop())
-            else:
-                return ret
+        return self.parentage.get_branch_from(node)
 
     def get_branch_spine(self, root):
         branch = self.get_branch_from(root)
         branch = branch[1:]
         spine = [branch[0].get_spine().coords[0]]
-        prepared = prep(self.bounds)
         for seg in branch:
-            seg_poly = seg.abs_polygon
-            if prepared.intersects(seg_poly):
+            if self.seg_in_bounds(seg):
                 spine.extend(seg.get_spine().coords[1:])
             else:
                 break
         return LineString(spine)
 
     def get_turtle_state_from(self, head):
+        """
+        Returns the turtle state after the given node. For nodes that are
+        materialised from a root and up to date, it follows from the pose
+        they were materialised with. Otherwise it is replayed from the top
+        of their tree.
+        """
+        if self.get_root_from(head).roadtype == TYPE_ROOT:
+            turtle = self.get_exit_turtle(head)
+            if turtle:
+                return turtle
+
         turtle = Turtle()
-        root = self.get_root_from(head)
-        path = shortest_path(self.parentage, root, head)
+        path = self.parentage.get_path_to(head)
         for node in path:
             turtle.move(node)
         return turtle
 
+    def get_fingerprint(self):
+        """
+        Returns a canonical fingerprint of this network along with its nodes
+        in the canonical order the fingerprint lists them in. The fingerprint
+        is made of the quantised pose of every root followed by the factory
+        keys of the segments hanging off it, and of the intersections between
+        segments that have been found reachable, given by canonical position.
+        Networks with equal fingerprints are the same up to float noise,
+        regardless of segment ids or the order segments were added in. The
+        fingerprint is None if intersections refer to segments that are no
+        longer part of the network, as those have no canonical position.
+        """
+        if self.fingerprint and not self.dirty and \
+                self.fingerprint[0] == self.version:
+            return self.fingerprint[1], self.fingerprint[2]
+
+        trees = []
+        for top in self.parentage.nodes():
+            if self.parentage.get_parent(top) is not None:
+                continue
+
+            pose = (top.key, quantise(top.x_off), quantise(top.y_off),
+                    quantise(top.angle), len(top.l_lanes), len(top.r_lanes))
+            order = [top]
+            tree = []
+            idx = 0
+            while idx < len(order):
+                for child in self.parentage[order[idx]]:
+                    tree.append((child.key, idx))
+                    order.append(child)
+                idx += 1
+            trees.append(((pose, tuple(tree)), order))
+        trees.sort(key=lambda tree: tree[0])
+
+        nodes = [node for _, order in trees for node in order]
+        positions = {node: idx for idx, node in enumerate(nodes)}
+        reachable = []
+        for from_node, to_node in self.reachability.edges():
+            if self.parentage.has_edge(from_node, to_node) or \
+                    self.parentage.has_edge(to_node, from_node):
+                continue
+            reachable.append((positions[from_node], positions[to_node]))
+        inters = []
+        for a_inter, b_inter in self.inters:
+            if a_inter not in positions or b_inter not in positions:
+                inters = None
+                break
+            inters.append((positions[a_inter], positions[b_inter]))
+
+        ret = None
+        if inters is not None:
+            bounds = None
+            if self.bounds is not None:
+                bounds = tuple(quantise(val) for val in self.bounds.bounds)
+            ret = (bounds, tuple(tree for tree, _ in trees),
+                   tuple(sorted(reachable)), tuple(sorted(inters)))
+
+        if not self.dirty:
+            self.fingerprint = (self.version, ret, nodes)
+        return ret, nodes
+
+    def get_bounds_box(self):
+        """
+        Returns the (minx, miny, maxx, maxy) box of the bounds of this network
+        if they are an axis aligned box, None otherwise.
+        """
+        if self.bounds_box is None:
+            self.bounds_box = ()
+            if box(*self.bounds.bounds).equals(self.bounds):
+                self.bounds_box = self.bounds.bounds
+        return self.bounds_box or None
+
+    def get_prepared_bounds(self):
+        if self.bounds_prep is None:
+            self.bounds_prep = prep(self.bounds)
+        return self.bounds_prep
+
+    def get_bounds_class(self, node):
+        """
+        Classifies the given segment as lying inside or outside of the bounds
+        or straddling their border by its bounding box alone. Segments whose
+        box touches the border count as straddling, as do all segments if the
+        bounds are not a box.
+        """
+        bounds_box = self.get_bounds_box()
+        seg_box = node.get_abs_bounds()
+        if bounds_box is None or seg_box is None:
+            return BOUNDS_STRADDLING
+        return classify_box(seg_box, bounds_box)
+
     def get_boundary_intersecting_nodes(self):
+        if self.boundary and not self.dirty and \
+                self.boundary[0] == self.version:
+            return {*self.boundary[1]}
+
         ret = set()
         boundary = self.bounds.exterior
         for node in self.parentage.nodes():
             if node.roadtype in GHOST_TYPES:
                 continue
 
+            # Segments entirely inside or outside can not reach the border
+            if self.get_bounds_class(node) != BOUNDS_STRADDLING:
+                continue
+
             spine = node.get_spine()
             intersect = boundary.intersection(spine)
-            if intersect.type == 'Point':
-                ret.add(node)
-            elif len(intersect.geoms) > 0:
+            if not intersect.is_empty:
                 ret.add(node)
 
-        return ret
+        if not self.dirty:
+            self.boundary = (self.version, ret)
+        return {*ret}
 
     def __copy__(self):
         return self.copy()
@@ -1205,28 +2458,34 @@ class NetworkLayout:
     def copy(self):
         ret = NetworkLayout(self.bounds)
         ret.seg_id = self.seg_id
-
-        nodes = {}
-        for node in self.parentage.nodes():
-            node_copy = node.copy()
-            nodes[node.seg_id] = node_copy
-
-        for edge in self.parentage.edges():
-            parent = nodes[edge[0].seg_id]
-            child = nodes[edge[1].seg_id]
-            ret.add_parentage(parent, child)
-
-        for from_node, to_node, data in self.reachability.edges(data=True):
-            from_node = nodes[from_node.seg_id]
-            to_node = nodes[to_node.seg_id]
-            # ret.add_reachable(from_node, to_node)
-
-        for edge in self.parentage.edges():
-            assert edge in ret.parentage.edges()
-
-        for edge in self.reachability.edges():
-            pass
-            # assert edge in ret.reachability.edges()
+        ret.bounds_box = self.bounds_box
+        ret.bounds_prep = self.bounds_prep
+
+        # Share nodes and parentage with the copy. Neither network owns the
+        # nodes afterwards, so whichever changes one first copies it.
+        self.owner_key = object()
+        self.parentage_shared = True
+        ret.parentage = self.parentage
+        ret.parentage_shared = True
+        ret.nodes = {**self.nodes}
+        ret.dirty = {*self.dirty}
+
+        # Without outdated nodes, the geometry of the copy is the same as
+        # ours, so our spatial index and, if it is still valid by its version
+        # stamp, our intersection table can be carried over as they are
+        if not self.dirty and self.spindex is not None:
+            self.spindex_shared = True
+            ret.spindex = self.spindex
+            ret.spindex_shared = True
+            ret.spindex_boxes = {**self.spindex_boxes}
+            ret.version = self.version
+            if self.intersections and \
+                    self.intersections.version == self.version:
+                ret.intersections = self.intersections
+
+        for parent, child in self.parentage.edges():
+            ret.add_reachable(parent, child)
+        ret.reachability.add_nodes_from(self.parentage.nodes())
 
         ret.update_abs()
         ret.check_reachable_intersections()
@@ -1241,12 +2500,10 @@ class NetworkLayout:
         if self.parentage.has_edge(bnode, anode):
             return False
 
-        anode_poly = anode.abs_polygon
-        intersecting = self.get_intersecting_nodes(anode_poly)
-        if bnode in intersecting:
-            aspine = anode.get_spine()
-            bspine = bnode.get_spine()
-            return aspine.intersects(bspine)
+        table = self.get_intersections()
+        if bnode in table.get_intersecting(anode):
+            intersection = table.get_spine_intersection(anode, bnode)
+            return not intersection.is_empty
 
         return False
 
@@ -1259,35 +2516,33 @@ class NetworkLayout:
                 remove.append((from_node, to_node))
         for from_node, to_node in remove:
             self.reachability.remove_edge(from_node, to_node)
+        self.closure = None
+        self.fingerprint = None
 
     def seg_in_bounds(self, seg):
+        bounds_class = self.get_bounds_class(seg)
+        if bounds_class == BOUNDS_INSIDE:
+            return True
+        if bounds_class == BOUNDS_OUTSIDE:
+            return False
         seg_poly = seg.abs_polygon
-        return not self.bounds.disjoint(seg_poly)
+        return not self.get_prepared_bounds().disjoint(seg_poly)
 
     def check_reachable_intersections(self):
         self.inters = list()
+        self.fingerprint = None
 
+        table = self.get_intersections()
         for segment in self.parentage.nodes():
             if segment.roadtype in GHOST_TYPES:
                 continue
 
-            if not self.seg_in_bounds(segment):
+            # Only segments within bounds are in the spatial index
+            if segment not in self.spindex_boxes:
                 continue
 
-            assert segment.abs_polygon
-            poly_seg = segment.abs_polygon
-            intersecting = self.get_intersecting_nodes(poly_seg)
-            for other in intersecting:
-                if segment == other:
-                    continue
-                if self.parentage.has_edge(segment, other):
-                    continue
-                if self.parentage.has_edge(other, segment):
-                    continue
-
-                own_spine = segment.get_spine()
-                oth_spine = other.get_spine()
-                intersection = own_spine.intersection(oth_spine)
+            for other in table.get_intersecting(segment):
+                intersection = table.get_spine_intersection(segment, other)
                 if intersection.geom_type != 'Point':
                     continue
 
@@ -1334,10 +2589,9 @@ class NetworkLayout:
         self.check_reachable_intersections()
 
     def remove_after(self, cut_point):
-        todo = {*self.get_children(cut_point)}
-        while todo:
-            node = todo.pop()
-            todo.update(self.get_children(node))
+        removed = self.parentage.get_subtree(cut_point)
+        # Leaves first, so no removal leaves a subtree behind to reindex
+        for node in reversed(removed):
             self.remove_node(node)
 
     def cut_branch(self, cut_point):
@@ -1398,36 +2652,84 @@ class NetworkLayout:
         self.add_parentage(parent, replacement)
         for child in children:
             self.add_parentage(replacement, child)
-        self.update_abs(force=True)
+        self.update_abs()
         self.check_reachable_intersections()
 
-    def get_difference(self, other):
-        own_roots = self.get_roots()
-        oth_roots = other.get_roots()
-
-        diff = 0.0
-        for own_root, oth_root in zip(own_roots, oth_roots):
-            own_x_off = own_root.x_off
-            own_y_off = own_root.y_off
-            own_offset = Point(own_x_off, own_y_off)
-
-            oth_x_off = oth_root.x_off
-            oth_y_off = oth_root.y_off
-            oth_offset = Point(oth_x_off, oth_y_off)
-
-            diff += own_offset.distance(oth_offset)
-            diff += math.fabs(own_root.angle - oth_root.angle)
-
-            own_branch = self.get_branch_from(own_root)
-            oth_branch = other.get_branch_from(oth_root)
-
-            for own_node, oth_node in zip(own_branch, oth_branch):
-                diff += own_node.get_difference(oth_node)
+    def get_root_branches(self):
+        roots = sorted(self.get_roots(), key=lambda root: root.seg_id)
+        return [(root, self.get_branch_from(root)) for root in roots]
+
+    def get_difference_shape(self):
+        """
+        Returns the longest branch, the most lanes and the most vertices of
+        any lane edge found among the branches of this network.
+        """
+        length, lanes, vertices = 0, 0, 0
+        for _, branch in self.get_root_branches():
+            length = max(length, len(branch))
+            for node in branch:
+                lanes = max(lanes, len(node.l_lanes) + len(node.r_lanes))
+                vertices = max(vertices, node.get_vertex_count())
+        return length, lanes, vertices
+
+    def get_difference_arrays(self, shape=None):
+        """
+        Returns the arrays get_difference works on: the (x, y, angle) pose of
+        each root, ordered by segment ID, the length of the branch from each
+        root, the left and right lane counts of every node on those branches
+        and their lane coordinates as given by get_lane_coords. Branches,
+        lanes and vertices are padded with NaN to the given shape, which
+        defaults to that of this network, so the arrays of networks padded
+        to the same shape can be compared.
+        """
+        branches = self.get_root_branches()
+        if shape is None:
+            shape = self.get_difference_shape()
+        length, lanes, vertices = shape
+
+        poses = np.zeros((len(branches), 3))
+        lengths = np.zeros(len(branches))
+        counts = np.full((len(branches), length, 2), np.nan)
+        coords = np.full((len(branches), length, lanes, 2, vertices, 2),
+                         np.nan)
+        for idx, (root, branch) in enumerate(branches):
+            poses[idx] = root.x_off, root.y_off, root.angle
+            lengths[idx] = len(branch)
+            for pos, node in enumerate(branch[:length]):
+                counts[idx, pos] = len(node.l_lanes), len(node.r_lanes)
+                coords[idx, pos] = node.get_lane_coords(lanes, vertices)
+
+        return poses, lengths, counts, coords
 
-            diff += math.fabs(len(own_branch) - len(oth_branch))
-        diff += math.fabs(len(own_roots) - len(oth_roots))
+    def get_difference(self, other):
+        shape = np.maximum(self.get_difference_shape(),
+                           other.get_difference_shape())
+        own_arrays = self.get_difference_arrays(shape)
+        oth_arrays = other.get_difference_arrays(shape)
+        return get_layout_difference(own_arrays, oth_arrays)
 
-        return diff
+    @staticmethod
+    def get_difference_matrix(networks):
+        """
+        Returns the (n, n) matrix of differences between each of the given
+        networks and every other one, as get_difference computes them. The
+        arrays of each network are built once for the whole matrix. The
+        difference is symmetric, so only the upper triangle is computed and
+        mirrored into the lower one.
+        """
+        shape = (0, 0, 0)
+        for network in networks:
+            shape = np.maximum(shape, network.get_difference_shape())
+        arrays = [network.get_difference_arrays(shape)
+                  for network in networks]
+
+        ret = np.zeros((len(networks), len(networks)))
+        for own_idx, own_arrays in enumerate(arrays):
+            for oth_idx in range(own_idx + 1, len(arrays)):
+                diff = get_layout_difference(own_arrays, arrays[oth_idx])
+                ret[own_idx, oth_idx] = diff
+                ret[oth_idx, own_idx] = diff
+        return ret
 
     def has_connected_boundary_segments(self):
         candidates = self.get_start_goal_candidates()
@@ -1471,17 +2773,12 @@ class NetworkLayout:
         self.update_abs()
 
         l.debug('Checking for self-intersecting branches.')
-        roots = self.get_roots()
-        for root in roots:
-            if self.branch_self_intersects(root):
-                l.debug('Found self-intersecting branch starting at: %s',
-                        str(root))
-                return False
+        if not self.check_self_intersections():
+            return False
         l.debug('No self-intersecting branches found.')
 
         l.debug('Testing for partially overlapping segments.')
-        if self.has_partial_overlaps():
-            l.debug('Found a partially overlapping pair.')
+        if not self.check_partial_overlaps():
             return False
 
         if not self.check_parentage():
@@ -1491,6 +2788,84 @@ class NetworkLayout:
         l.debug('No issues found. Network considered consistent.')
         return True
 
+    def check_growth(self, segments):
+        """
+        Tells if the network is consistent in the sense of is_consistent
+        after the given segments were added to it, provided it was before.
+        New conflicts have to involve the new segments, so only they and the
+        segments they intersect are checked, finding intersecting segments
+        through the spatial index instead of building the intersection table
+        of the whole network.
+        """
+        self.update_abs()
+        segments = [segment for segment in segments
+                    if segment.roadtype not in GHOST_TYPES]
+
+        for segment in segments:
+            parent = self.get_parent(segment)
+            if parent is not None and len(self.parentage[parent]) > 1:
+                l.info('Network has nodes with too many children!')
+                return False
+
+        affected = OrderedDict()
+        for segment in segments:
+            affected[segment] = self.get_segment_intersecting_nodes(segment)
+            for other in affected[segment]:
+                affected.setdefault(other, None)
+
+            # Segments outside of the bounds are not indexed, yet still
+            # intersect the indexed segments they overlap
+            if self.get_bounds_class(segment) != BOUNDS_INSIDE:
+                for other in self.parentage.nodes():
+                    if other.roadtype in GHOST_TYPES:
+                        continue
+                    if other not in self.spindex_boxes:
+                        affected.setdefault(other, None)
+
+        for node, intersecting in affected.items():
+            if intersecting is None:
+                intersecting = self.get_segment_intersecting_nodes(node)
+
+            root = self.get_root_from(node)
+            if root.roadtype == TYPE_ROOT:
+                for other in intersecting:
+                    if self.get_root_from(other) == root:
+                        l.debug('Found self-intersecting branch starting '
+                                'at: %s', str(root))
+                        return False
+
+            if len(intersecting) > 1:
+                l.debug('Found %s intersecting nodes for %s',
+                        len(intersecting), str(node))
+                return False
+
+            if intersecting:
+                other = intersecting[0]
+                intersection = node.get_spine().intersection(other.get_spine())
+                if intersection.geom_type != 'Point':
+                    return False
+                if not self.is_full_crossing(node, other, intersection):
+                    l.debug('Crossing between %s x %s is not full.',
+                            str(node), str(other))
+                    return False
+
+        return True
+
+    def check_self_intersections(self):
+        roots = self.get_roots()
+        for root in roots:
+            if self.branch_self_intersects(root):
+                l.debug('Found self-intersecting branch starting at: %s',
+                        str(root))
+                return False
+        return True
+
+    def check_partial_overlaps(self):
+        if self.has_partial_overlaps():
+            l.debug('Found a partially overlapping pair.')
+            return False
+        return True
+
     def check_branch_lengths(self):
         roots = self.get_roots()
         min_length = self.bounds.bounds[2] - self.bounds.bounds[0]
@@ -1504,6 +2879,7 @@ class NetworkLayout:
         return True
 
     def all_branches_connected(self):
+        table = self.get_intersections()
         roots = self.get_nodes(TYPE_ROOT)
         l.info('Got roots')
         if len(roots) > 1:
@@ -1515,8 +2891,7 @@ class NetworkLayout:
                     if seg.roadtype in GHOST_TYPES:
                         continue
 
-                    intersecting = self.get_segment_intersecting_nodes(seg)
-                    if intersecting:
+                    if table.get_intersecting(seg):
                         clear = True
                         l.info('Found an intersection for %s', root)
                         break
@@ -1540,25 +2915,49 @@ class NetworkLayout:
             return False
         return True
 
-    def complete_is_consistent(self):
-        if not self.is_consistent():
-            return False
-
-        if not self.clean_intersection_check():
-            l.debug('intersections broken!')
-            return False
+    # Checks run by complete_is_consistent, each given as name and method
+    # returning if it passed. Checks come in order of increasing cost per
+    # rejection as measured by CONSISTENCY_STATS during evolution. Checks
+    # working off the intersection table are cheap since the table has been
+    # built for reachability already.
+    CONSISTENCY_CHECKS = (
+        ('parentage', 'check_parentage'),
+        ('branches_connected', 'all_branches_connected'),
+        ('partial_overlaps', 'check_partial_overlaps'),
+        ('self_intersections', 'check_self_intersections'),
+        ('boundary_segments', 'has_connected_boundary_segments'),
+        ('branch_lengths', 'check_branch_lengths'),
+        ('clean_intersections', 'clean_intersection_check'),
+    )
 
-        if not self.has_connected_boundary_segments():
-            l.debug('No two boundary segments are reachable.')
-            return False
-
-        if not self.all_branches_connected():
-            l.debug('Not all branches are reachable from each other.')
-            return False
+    def complete_is_consistent(self):
+        """
+        Runs the full consistency check on this network. Verdicts are kept in
+        a memo shared by all networks, keyed by fingerprint, so networks that
+        have been checked before in any form are not checked again.
+        """
+        self.update_abs()
+        fingerprint, _ = self.get_fingerprint()
+        if fingerprint is None:
+            return self.check_complete_consistency()
+        if fingerprint in CONSISTENCY_VERDICTS:
+            return CONSISTENCY_VERDICTS.get(fingerprint)
+
+        ret = self.check_complete_consistency()
+        CONSISTENCY_VERDICTS.put(fingerprint, ret)
+        return ret
 
-        if not self.check_branch_lengths():
-            l.debug('Not all branches are long enough')
-            return False
+    def check_complete_consistency(self):
+        self.update_abs()
+        for name, check in NetworkLayout.CONSISTENCY_CHECKS:
+            beg = perf_counter()
+            passed = getattr(self, check)()
+            duration = perf_counter() - beg
+            self.check_stats.record(name, passed, duration)
+            CONSISTENCY_STATS.record(name, passed, duration)
+            if not passed:
+                l.debug('Network failed consistency check: %s', name)
+                return False
 
         l.info('Network is completely consistent.')
         return True
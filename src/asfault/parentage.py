@@ -0,0 +1,217 @@
+import networkx
+
+
+class Parentage:
+    """
+    Parentage forest of a network layout. Consistent networks only consist of
+    simple chains of segments hanging off their roots, so instead of a general
+    graph this keeps the parent and the ordered children of every node along
+    with its root and depth, all updated as nodes and edges are added and
+    removed. Nodes cut off from their parent become the top of a tree of their
+    own until they are attached again. Nodes with more than one child are
+    still representable, so inconsistent networks can be built and rejected.
+
+    The chain of each tree, its top followed by every node down to the first
+    one without exactly one child, is built on demand and kept as an array
+    until the tree changes anywhere but at the end of the chain. Branches and
+    paths from the root are slices of it.
+
+    The graph methods networkx offers that the rest of the code relies on are
+    supported with the same iteration order, and to_networkx gives a full
+    networkx view for anything else.
+    """
+
+    def __init__(self):
+        # Also the set of nodes, in the order they were added
+        self.children = {}
+        self.parents = {}
+        self.roots = {}
+        self.depths = {}
+        self.chains = {}
+
+    def __contains__(self, node):
+        return node in self.children
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+    def __getitem__(self, node):
+        return self.children[node]
+
+    def nodes(self):
+        return self.children.keys()
+
+    def edges(self):
+        ret = []
+        for parent, children in self.children.items():
+            for child in children:
+                ret.append((parent, child))
+        return ret
+
+    def has_node(self, node):
+        return node in self.children
+
+    def has_edge(self, parent, child):
+        return child in self.parents and self.parents[child] == parent
+
+    def successors(self, node):
+        return iter(self.children[node])
+
+    def predecessors(self, node):
+        if node not in self.children:
+            raise KeyError(node)
+        if node in self.parents:
+            return iter((self.parents[node],))
+        return iter(())
+
+    def copy(self):
+        ret = Parentage()
+        ret.children = {node: [*children]
+                        for node, children in self.children.items()}
+        ret.parents = {**self.parents}
+        ret.roots = {**self.roots}
+        ret.depths = {**self.depths}
+        ret.chains = {root: [*chain] for root, chain in self.chains.items()}
+        return ret
+
+    def relabeled(self, mapping):
+        """
+        Returns a copy of this forest with nodes replaced according to the
+        given mapping, like networkx.relabel_nodes does for graphs.
+        """
+        def get(node):
+            return mapping.get(node, node)
+
+        ret = Parentage()
+        ret.children = {get(node): [get(child) for child in children]
+                        for node, children in self.children.items()}
+        ret.parents = {get(child): get(parent)
+                       for child, parent in self.parents.items()}
+        ret.roots = {get(node): get(root) for node, root in self.roots.items()}
+        ret.depths = {get(node): depth for node, depth in self.depths.items()}
+        ret.chains = {get(root): [get(node) for node in chain]
+                      for root, chain in self.chains.items()}
+        return ret
+
+    def to_networkx(self):
+        ret = networkx.DiGraph()
+        ret.add_nodes_from(self.children)
+        ret.add_edges_from(self.edges())
+        return ret
+
+    def add_node(self, node):
+        if node not in self.children:
+            self.children[node] = []
+            self.roots[node] = node
+            self.depths[node] = 0
+
+    def add_edge(self, parent, child):
+        self.add_node(parent)
+        self.add_node(child)
+        old_parent = self.parents.get(child, None)
+        if old_parent == parent:
+            return
+        if old_parent is not None:
+            self.children[old_parent].remove(child)
+            self.chains.pop(self.roots[old_parent], None)
+
+        self.parents[child] = parent
+        self.children[parent].append(child)
+        root = self.roots[parent]
+        self.update_subtree(child, root, self.depths[parent] + 1)
+
+        child_chain = self.chains.pop(child, None)
+        chain = self.chains.get(root, None)
+        if chain is not None:
+            if chain[-1] == parent and len(self.children[parent]) == 1:
+                if child_chain is None:
+                    child_chain = self.build_chain(child)
+                chain.extend(child_chain)
+            else:
+                del self.chains[root]
+
+    def remove_node(self, node):
+        root = self.roots.pop(node)
+        del self.depths[node]
+        self.chains.pop(root, None)
+        parent = self.parents.pop(node, None)
+        if parent is not None:
+            self.children[parent].remove(node)
+        for child in self.children.pop(node):
+            del self.parents[child]
+            self.update_subtree(child, child, 0)
+
+    def update_subtree(self, top, root, depth):
+        todo = [(top, depth)]
+        while todo:
+            node, depth = todo.pop()
+            self.roots[node] = root
+            self.depths[node] = depth
+            for child in self.children[node]:
+                todo.append((child, depth + 1))
+
+    def build_chain(self, top):
+        ret = [top]
+        children = self.children[top]
+        while len(children) == 1:
+            ret.append(children[0])
+            children = self.children[children[0]]
+        return ret
+
+    def get_chain(self, root):
+        ret = self.chains.get(root, None)
+        if ret is None:
+            ret = self.build_chain(root)
+            self.chains[root] = ret
+        return ret
+
+    def get_parent(self, node):
+        return self.parents.get(node, None)
+
+    def get_root(self, node):
+        return self.roots[node]
+
+    def get_depth(self, node):
+        return self.depths[node]
+
+    def get_branch_from(self, node):
+        """
+        Returns the given node followed by its descendants down to the first
+        one that does not have exactly one child.
+        """
+        chain = self.get_chain(self.roots[node])
+        depth = self.depths[node]
+        if depth < len(chain) and chain[depth] == node:
+            return chain[depth:]
+        return self.build_chain(node)
+
+    def get_path_to(self, node):
+        """
+        Returns the nodes from the top of the tree of the given node down to
+        the node itself.
+        """
+        chain = self.get_chain(self.roots[node])
+        depth = self.depths[node]
+        if depth < len(chain) and chain[depth] == node:
+            return chain[:depth + 1]
+        ret = [node]
+        while ret[-1] in self.parents:
+            ret.append(self.parents[ret[-1]])
+        ret.reverse()
+        return ret
+
+    def get_subtree(self, node):
+        """
+        Returns the descendants of the given node, parents before their
+        children.
+        """
+        ret = []
+        todo = [*self.children[node]]
+        while todo:
+            cursor = todo.pop()
+            ret.append(cursor)
+            todo.extend(self.children[cursor])
+        return ret
@@ -0,0 +1,200 @@
+import heapq
+import itertools
+
+from networkx.algorithms.dag import ancestors
+
+from asfault import config as c
+
+
+def weigh_count(node):
+    return 1
+
+
+class PathSearch:
+    """
+    Depth-first branch and bound search for the k simple paths from one node
+    of a reachability graph to a goal node that have the highest total node
+    weight. Nodes are weighed by a pluggable function that should be cheap,
+    since it works on the graph alone and never looks at path geometry.
+
+    Partial paths are pruned when even collecting every node that remains
+    reachable from their end, without passing through nodes already on the
+    path, could not beat the k-th best path found so far. That bound never
+    underestimates the weight a path can still gain, so pruned paths can
+    never be among the best. Runs of nodes with only one way to continue are
+    followed without branching, so only junctions count against the budget.
+    Once the budget is spent, the best paths found so far are returned.
+    """
+
+    def __init__(self, graph, goal, weigh=weigh_count, budget=None):
+        if budget is None:
+            budget = c.ev.path_search_budget
+        self.graph = graph
+        self.goal = goal
+        self.weigh = weigh
+        self.budget = budget
+        self.weights = {}
+        # Only nodes that can still reach the goal can be part of a path
+        self.relevant = ancestors(graph, goal)
+        self.relevant.add(goal)
+
+        self.found = []
+        self.counter = itertools.count()
+        self.expansions = 0
+        self.k = 0
+
+    def get_weight(self, node):
+        ret = self.weights.get(node, None)
+        if ret is None:
+            ret = self.weigh(node)
+            self.weights[node] = ret
+        return ret
+
+    def get_bound(self, node, visited):
+        """
+        Returns the total weight of the nodes a path continuing at the given
+        node could still visit, or None if the goal can not be reached from
+        it without going through the visited nodes.
+        """
+        seen = {node}
+        queue = [node]
+        total = self.get_weight(node)
+        reached = False
+        while queue:
+            cur = queue.pop()
+            if cur == self.goal:
+                # Paths end at the goal, so nothing is collected beyond it
+                reached = True
+                continue
+            for nxt in self.graph.adj[cur]:
+                if nxt in seen or nxt in visited or nxt not in self.relevant:
+                    continue
+                seen.add(nxt)
+                total += self.get_weight(nxt)
+                queue.append(nxt)
+
+        if reached:
+            return total
+        return None
+
+    def can_improve(self, score):
+        if len(self.found) < self.k:
+            return True
+        return score > self.found[0][0]
+
+    def record(self, path, score):
+        # Earlier paths win ties, hence the negated counter
+        entry = (score, -next(self.counter), list(path))
+        if len(self.found) < self.k:
+            heapq.heappush(self.found, entry)
+        elif entry > self.found[0]:
+            heapq.heapreplace(self.found, entry)
+
+    def extend(self, path, visited, score):
+        node = path[-1]
+        chain = 0
+        options = []
+        while True:
+            if node == self.goal:
+                self.record(path, score)
+                break
+
+            options = [nxt for nxt in self.graph.adj[node]
+                       if nxt not in visited and nxt in self.relevant]
+            if len(options) != 1:
+                break
+
+            node = options[0]
+            path.append(node)
+            visited.add(node)
+            score += self.get_weight(node)
+            chain += 1
+
+        if node != self.goal and options and self.expansions < self.budget:
+            self.expansions += 1
+            bounded = []
+            for nxt in options:
+                bound = self.get_bound(nxt, visited)
+                if bound is not None:
+                    bounded.append((bound, nxt))
+            # Most promising branches first, so good paths are found early
+            # and prune the rest
+            bounded.sort(key=lambda option: -option[0])
+
+            for bound, nxt in bounded:
+                if not self.can_improve(score + bound):
+                    break
+                path.append(nxt)
+                visited.add(nxt)
+                self.extend(path, visited, score + self.get_weight(nxt))
+                visited.discard(nxt)
+                path.pop()
+
+        for _ in range(chain):
+            visited.discard(path.pop())
+
+    def search(self, start, k):
+        """
+        Returns up to k paths from the given start node to the goal as lists
+        of nodes, ordered from highest to lowest weight.
+        """
+        self.found = []
+        self.expansions = 0
+        self.k = k
+        if k < 1 or start not in self.relevant:
+            return []
+
+        if self.get_bound(start, set()) is not None:
+            self.extend([start], {start}, self.get_weight(start))
+
+        ret = sorted(self.found, reverse=True)
+        ret = [path for _, _, path in ret]
+        return ret
+
+
+def best_paths(graph, start, goal, weigh=weigh_count, k=None, budget=None):
+    """
+    Returns up to k of the simple paths from start to goal in the given graph
+    with the highest total weight under the given node weighing function,
+    best first. k defaults to the number of path candidates set in the
+    evolution config.
+    """
+    if k is None:
+        k = c.ev.path_candidates
+    search = PathSearch(graph, goal, weigh=weigh, budget=budget)
+    return search.search(start, k)
+
+
+def random_paths(graph, start, goal, rng, k=None):
+    """
+    Returns up to k distinct simple paths from start to goal in the given
+    graph, each drawn by a walk that picks uniformly among the next nodes
+    the goal can still be reached from without going through the path so
+    far. Unlike the paths of best_paths, they are not ranked by any weight.
+    Paths drawn more than once are only returned once.
+    """
+    if k is None:
+        k = c.ev.path_candidates
+    search = PathSearch(graph, goal)
+    if k < 1 or start not in search.relevant:
+        return []
+    if search.get_bound(start, set()) is None:
+        return []
+
+    ret = []
+    seen = set()
+    for _ in range(k):
+        path = [start]
+        visited = {start}
+        while path[-1] != goal:
+            options = [nxt for nxt in graph.adj[path[-1]]
+                       if nxt not in visited and nxt in search.relevant and
+                       search.get_bound(nxt, visited) is not None]
+            nxt = rng.choice(options)
+            path.append(nxt)
+            visited.add(nxt)
+
+        if tuple(path) not in seen:
+            seen.add(tuple(path))
+            ret.append(path)
+    return ret
@@ -0,0 +1,154 @@
+import gzip
+import json
+import os
+
+from asfault import config as c
+
+POOL_SUFFIX = '.json.gz'
+POOL_TMP_SUFFIX = '.tmp'
+POOL_CLAIM_SUFFIX = '.claim'
+POOL_SEED = 'seed'
+POOL_POSITION = 'position'
+
+
+def get_pool_key(estimator):
+    """
+    Returns the name of the pool holding layouts grown under the current
+    evolution config, with start, goal and path picked by the given kind of
+    estimator. Layouts grown under different settings never mix.
+    """
+    return '{}_{}x{}_{}_{}_{}{}_{}x{}_{}'.format(
+        c.ev.bounds, c.ev.l_lanes, c.ev.r_lanes, c.ev.lane_width,
+        c.ev.max_angle, c.ev.generation_restarts, c.ev.generation_step_budget,
+        c.ev.path_candidates, c.ev.path_search_budget,
+        type(estimator).__name__)
+
+
+def get_pool_path(estimator):
+    return os.path.join(c.rg.get_pool_path(), get_pool_key(estimator))
+
+
+def write_atomic(path, text):
+    tmp_path = path + POOL_TMP_SUFFIX
+    with open(tmp_path, 'w') as outfile:
+        outfile.write(text)
+    os.replace(tmp_path, path)
+
+
+class LayoutPool:
+    """
+    Directory of pre-generated tests shared by all runs with the same
+    generation settings, one gzipped JSON file per test in the format of
+    RoadTest.to_dict, named after its index in the pool. Entries only depend
+    on their index and the seed of the pool, which is stored in the
+    directory along with the position of the next entry to hand out, so
+    every run picks up the entries the previous one left. Files are written
+    under a temporary name and renamed once complete, so entries appear
+    atomically, and taking an entry deletes its file.
+
+    Processes claim an index before growing its entry by creating a claim
+    file, so no entry is grown twice at the same time. A pool is meant to
+    be used by one run at a time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        c.ensure_directory(path)
+
+    def get_entry_path(self, index):
+        return os.path.join(self.path, '{:08}{}'.format(index, POOL_SUFFIX))
+
+    def get_claim_path(self, index):
+        return os.path.join(self.path,
+                            '{:08}{}'.format(index, POOL_CLAIM_SUFFIX))
+
+    def get_seed(self, default):
+        """
+        Returns the seed of the pool, making it the given one if the pool
+        does not have one yet.
+        """
+        path = os.path.join(self.path, POOL_SEED)
+        if not os.path.exists(path):
+            write_atomic(path, str(default))
+        with open(path, 'r') as infile:
+            return int(infile.read())
+
+    def get_position(self):
+        path = os.path.join(self.path, POOL_POSITION)
+        if not os.path.exists(path):
+            return 0
+        with open(path, 'r') as infile:
+            return int(infile.read())
+
+    def set_position(self, index):
+        write_atomic(os.path.join(self.path, POOL_POSITION), str(index))
+
+    def get_indices(self):
+        ret = [int(entry.name[:-len(POOL_SUFFIX)])
+               for entry in os.scandir(self.path)
+               if entry.name.endswith(POOL_SUFFIX)]
+        ret.sort()
+        return ret
+
+    def __len__(self):
+        return len(self.get_indices())
+
+    def has(self, index):
+        return os.path.exists(self.get_entry_path(index))
+
+    def put(self, index, entry):
+        path = self.get_entry_path(index)
+        tmp_path = path + POOL_TMP_SUFFIX
+        with gzip.open(tmp_path, 'wt') as outfile:
+            json.dump(entry, outfile, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    def take(self, index):
+        """
+        Removes the entry of the given index from the pool and returns it, or
+        None if the pool does not have it.
+        """
+        path = self.get_entry_path(index)
+        try:
+            with gzip.open(path, 'rt') as infile:
+                ret = json.load(infile)
+            os.remove(path)
+        except FileNotFoundError:
+            return None
+        return ret
+
+    def is_claimed(self, index):
+        return os.path.exists(self.get_claim_path(index))
+
+    def claim(self, index):
+        """
+        Claims the given index for growing its entry. Returns whether the
+        claim succeeded, which it does not if another process holds it.
+        """
+        try:
+            fd = os.open(self.get_claim_path(index),
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        os.close(fd)
+        return True
+
+    def release(self, index):
+        try:
+            os.remove(self.get_claim_path(index))
+        except FileNotFoundError:
+            pass
+
+    def release_all(self):
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(POOL_CLAIM_SUFFIX):
+                self.release(int(entry.name[:-len(POOL_CLAIM_SUFFIX)]))
+
+    def discard_before(self, index):
+        for old in self.get_indices():
+            if old >= index:
+                break
+            try:
+                os.remove(self.get_entry_path(old))
+            except FileNotFoundError:
+                continue
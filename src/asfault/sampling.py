@@ -0,0 +1,107 @@
+class AliasTable:
+    """
+    Samples indices in proportion to fixed weights in constant time using
+    Walker's alias method. Every index owns an equally likely slot, which
+    hands the part of its probability it does not need to one alias.
+    """
+
+    def __init__(self, weights):
+        count = len(weights)
+        total = float(sum(weights))
+        if not count or total <= 0:
+            raise ValueError('Need positive weights to sample from.')
+
+        self.uniform = len(set(weights)) == 1
+        self.probs = [1.0] * count
+        self.aliases = list(range(count))
+        if self.uniform:
+            return
+
+        scaled = [weight * count / total for weight in weights]
+        small = [idx for idx, prob in enumerate(scaled) if prob < 1.0]
+        large = [idx for idx, prob in enumerate(scaled) if prob >= 1.0]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.probs[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+
+    def __len__(self):
+        return len(self.probs)
+
+    def sample(self, rng):
+        idx = rng.randrange(len(self.probs))
+        if self.uniform or rng.random() < self.probs[idx]:
+            return idx
+        return self.aliases[idx]
+
+
+class FactoryTable:
+    """
+    Fixed table of factory keys split into groups, from which keys are
+    sampled in proportion to their weight. Factories are only ever ruled out
+    a whole group at a time, so the factories available to a caller are
+    described by a bitmask of the groups left, with one bit per group.
+    Sampling picks a group by its total weight and a key from an alias table
+    within the group, so it neither depends on the number of keys nor
+    allocates anything.
+    """
+
+    def __init__(self, keys, get_group, weights=None):
+        self.keys = tuple(keys)
+        if weights is None:
+            weights = {}
+
+        groups = {}
+        for key in self.keys:
+            groups.setdefault(get_group(key), []).append(key)
+
+        self.groups = list(groups.keys())
+        self.members = [groups[group] for group in self.groups]
+        self.bits = {}
+        self.tables = []
+        self.weights = []
+        for idx, members in enumerate(self.members):
+            member_weights = [weights.get(key, 1.0) for key in members]
+            self.tables.append(AliasTable(member_weights))
+            self.weights.append(sum(member_weights))
+            for key in members:
+                self.bits[key] = 1 << idx
+        self.full = (1 << len(self.groups)) - 1
+
+    def sample(self, rng, mask):
+        """
+        Returns a random key out of the groups in the given mask, or None if
+        the mask is empty.
+        """
+        total = 0.0
+        last = None
+        for idx, weight in enumerate(self.weights):
+            if mask & (1 << idx):
+                total += weight
+                last = idx
+        if last is None:
+            return None
+
+        point = rng.random() * total
+        chosen = last
+        for idx, weight in enumerate(self.weights):
+            if mask & (1 << idx):
+                if point < weight:
+                    chosen = idx
+                    break
+                point -= weight
+
+        members = self.members[chosen]
+        return members[self.tables[chosen].sample(rng)]
+
+    def remove_group(self, mask, key):
+        """
+        Returns the given mask without the group of the given key.
+        """
+        return mask & ~self.bits[key]
@@ -0,0 +1,305 @@
+import math
+
+from collections import defaultdict
+
+import numpy as np
+from pyqtree import Index
+
+from asfault import config as c
+
+INDEX_QUADTREE = 'quadtree'
+INDEX_RTREE = 'rtree'
+INDEX_GRID = 'grid'
+
+RTREE_NODE_CAPACITY = 16
+RTREE_REPACK_MIN = 32
+RTREE_REPACK_RATIO = 0.25
+
+GRID_CELL_LANES = 32
+
+
+class SpatialIndex:
+    """
+    Common interface of the spatial indices NetworkLayout can use. Items are
+    stored with their (minx, miny, maxx, maxy) bounding box and queries
+    return every item whose box intersects the query box.
+    """
+
+    def insert(self, item, bbox):
+        raise NotImplementedError()
+
+    def remove(self, item, bbox):
+        raise NotImplementedError()
+
+    def intersect(self, bbox):
+        raise NotImplementedError()
+
+    def __len__(self):
+        raise NotImplementedError()
+
+
+class QuadTreeIndex(SpatialIndex):
+    def __init__(self, bounds, entries=()):
+        bbox = []
+        for val in bounds:
+            bbox.append(val * 2)
+        self.tree = Index(bbox=bbox)
+        self.count = 0
+        for item, bbox in entries:
+            self.insert(item, bbox)
+
+    def insert(self, item, bbox):
+        self.tree.insert(item, bbox)
+        self.count += 1
+
+    def remove(self, item, bbox):
+        self.tree.remove(item, bbox)
+        self.count -= 1
+
+    def intersect(self, bbox):
+        return self.tree.intersect(bbox)
+
+    def __len__(self):
+        return self.count
+
+
+class PackedRTreeIndex(SpatialIndex):
+    """
+    R-tree bulk-loaded with the Sort-Tile-Recursive algorithm. Each level of
+    the tree is a flat array of boxes and the children of node i on one level
+    are the entries [i * capacity, (i + 1) * capacity) on the level below.
+    Packing is vectorised, but queries descend one level at a time over
+    plain lists of boxes, since nodes are far too small for NumPy to pay
+    off.
+
+    The tree builds much faster than the quadtree, but queries are no faster:
+    on networks of 50 to 2000 segments in bounds of 1000 and 3000 its box
+    queries range from a quarter faster to a quarter slower than those of
+    the quadtree and its point queries take up to twice as long. With 2000
+    segments in bounds of 3000, box queries took 19.6us against 17.1us for
+    the quadtree and 10.7us for the grid index.
+
+    The packed tree itself is static. Items inserted afterwards go to a small
+    overflow list and removed items are masked out until enough changes
+    accumulated to warrant packing the tree again.
+    """
+
+    def __init__(self, bounds=None, entries=(), capacity=RTREE_NODE_CAPACITY):
+        self.capacity = capacity
+        self.pack(list(entries))
+
+    def pack(self, entries):
+        self.items = [item for item, _ in entries]
+        self.slots = {item: idx for idx, item in enumerate(self.items)}
+        self.alive = [True] * len(self.items)
+        self.removed = 0
+        self.overflow = {}
+
+        if not entries:
+            self.levels = []
+            self.nodes = []
+            return
+
+        boxes = np.array([bbox for _, bbox in entries], dtype=np.float64)
+        order = self.sort_tile(boxes)
+        self.items = [self.items[idx] for idx in order]
+        self.slots = {item: idx for idx, item in enumerate(self.items)}
+
+        level = boxes[order]
+        self.levels = [level]
+        while len(level) > self.capacity:
+            level = self.pack_level(level)
+            self.levels.append(level)
+        self.levels.reverse()
+        self.nodes = [level.tolist() for level in self.levels]
+
+    def sort_tile(self, boxes):
+        count = len(boxes)
+        centres = (boxes[:, :2] + boxes[:, 2:]) / 2.0
+        leaves = math.ceil(count / self.capacity)
+        slices = math.ceil(math.sqrt(leaves))
+        slice_size = slices * self.capacity
+
+        order = np.argsort(centres[:, 0], kind='stable')
+        ret = []
+        for beg in range(0, count, slice_size):
+            tile = order[beg:beg + slice_size]
+            tile = tile[np.argsort(centres[tile, 1], kind='stable')]
+            ret.append(tile)
+        return np.concatenate(ret)
+
+    def pack_level(self, boxes):
+        # Boxes are already in tile order, so every run of capacity entries
+        # becomes one parent node on the level above
+        count = len(boxes)
+        parents = math.ceil(count / self.capacity)
+        pad = parents * self.capacity - count
+        padded = np.concatenate([boxes, np.repeat(boxes[-1:], pad, axis=0)])
+        padded = padded.reshape(parents, self.capacity, 4)
+        ret = np.empty((parents, 4), dtype=np.float64)
+        ret[:, :2] = padded[:, :, :2].min(axis=1)
+        ret[:, 2:] = padded[:, :, 2:].max(axis=1)
+        return ret
+
+    def insert(self, item, bbox):
+        self.overflow[item] = tuple(bbox)
+        self.repack_if_needed()
+
+    def remove(self, item, bbox):
+        if item in self.overflow:
+            del self.overflow[item]
+            return
+
+        idx = self.slots.pop(item)
+        self.alive[idx] = False
+        self.removed += 1
+        self.repack_if_needed()
+
+    def repack_if_needed(self):
+        changes = len(self.overflow) + self.removed
+        threshold = max(RTREE_REPACK_MIN, len(self.slots) * RTREE_REPACK_RATIO)
+        if changes > threshold:
+            self.pack(self.entries())
+
+    def entries(self):
+        ret = []
+        if self.levels:
+            leaves = self.levels[-1]
+            for idx, item in enumerate(self.items):
+                if self.alive[idx]:
+                    ret.append((item, tuple(leaves[idx])))
+        ret.extend(self.overflow.items())
+        return ret
+
+    def intersect(self, bbox):
+        min_x, min_y, max_x, max_y = bbox
+        ret = []
+        if self.nodes:
+            capacity = self.capacity
+            candidates = range(len(self.nodes[0]))
+            for depth, boxes in enumerate(self.nodes):
+                if depth:
+                    count = len(boxes)
+                    candidates = [child for idx in candidates
+                                  for child in range(idx * capacity,
+                                                     min((idx + 1) * capacity,
+                                                         count))]
+                hits = []
+                for idx in candidates:
+                    node = boxes[idx]
+                    if node[2] >= min_x and node[0] <= max_x and \
+                            node[3] >= min_y and node[1] <= max_y:
+                        hits.append(idx)
+                candidates = hits
+                if not candidates:
+                    break
+
+            for idx in candidates:
+                if self.alive[idx]:
+                    ret.append(self.items[idx])
+
+        for item, item_box in self.overflow.items():
+            if item_box[2] >= bbox[0] and item_box[0] <= bbox[2] and \
+                    item_box[3] >= bbox[1] and item_box[1] <= bbox[3]:
+                ret.append(item)
+
+        return ret
+
+    def __len__(self):
+        return len(self.slots) + len(self.overflow)
+
+
+class GridIndex(SpatialIndex):
+    """
+    Uniform hash grid. Every item is registered along with its box in each
+    cell its box covers, so queries only look at the cells covered by the
+    query box. Items found in several of those cells are only reported in
+    the cell holding the lower left corner of the overlap of their box with
+    the query box, which spares keeping track of the items already seen.
+    """
+
+    def __init__(self, bounds=None, entries=(), cell_size=None):
+        if not cell_size:
+            cell_size = c.ev.lane_width * GRID_CELL_LANES
+        self.cell_size = cell_size
+        self.cells = defaultdict(list)
+        self.boxes = {}
+        for item, bbox in entries:
+            self.insert(item, bbox)
+
+    def get_cells(self, bbox):
+        min_x = math.floor(bbox[0] / self.cell_size)
+        min_y = math.floor(bbox[1] / self.cell_size)
+        max_x = math.floor(bbox[2] / self.cell_size)
+        max_y = math.floor(bbox[3] / self.cell_size)
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                yield x, y
+
+    def insert(self, item, bbox):
+        entry = (item, tuple(bbox))
+        self.boxes[item] = entry
+        for cell in self.get_cells(bbox):
+            self.cells[cell].append(entry)
+
+    def remove(self, item, bbox):
+        entry = self.boxes.pop(item)
+        for cell in self.get_cells(entry[1]):
+            entries = self.cells[cell]
+            entries.remove(entry)
+            if not entries:
+                del self.cells[cell]
+
+    def intersect(self, bbox):
+        min_x, min_y, max_x, max_y = bbox
+        size = self.cell_size
+        beg_x = math.floor(min_x / size)
+        beg_y = math.floor(min_y / size)
+        end_x = math.floor(max_x / size)
+        end_y = math.floor(max_y / size)
+        cells = self.cells
+
+        if beg_x == end_x and beg_y == end_y:
+            entries = cells.get((beg_x, beg_y), ())
+            return [item for item, box in entries
+                    if box[2] >= min_x and box[0] <= max_x and
+                    box[3] >= min_y and box[1] <= max_y]
+
+        ret = []
+        for x in range(beg_x, end_x + 1):
+            for y in range(beg_y, end_y + 1):
+                entries = cells.get((x, y), None)
+                if not entries:
+                    continue
+                for item, box in entries:
+                    if box[2] >= min_x and box[0] <= max_x and \
+                            box[3] >= min_y and box[1] <= max_y:
+                        corner_x = box[0] if box[0] > min_x else min_x
+                        corner_y = box[1] if box[1] > min_y else min_y
+                        if math.floor(corner_x / size) == x and \
+                                math.floor(corner_y / size) == y:
+                            ret.append(item)
+        return ret
+
+    def __len__(self):
+        return len(self.boxes)
+
+
+INDICES = {
+    INDEX_QUADTREE: QuadTreeIndex,
+    INDEX_RTREE: PackedRTreeIndex,
+    INDEX_GRID: GridIndex,
+}
+
+
+def create_index(bounds, entries=(), kind=None):
+    """
+    Creates a spatial index of the given kind, defaulting to the one
+    configured in the evolution config, and bulk loads the given
+    (item, bbox) entries into it.
+    """
+    if not kind:
+        kind = c.ev.spatial_index
+    if kind not in INDICES:
+        raise ValueError('Unknown spatial index: {}'.format(kind))
+    return INDICES[kind](bounds, entries)
@@ -0,0 +1,98 @@
+import random
+
+import pytest
+
+from asfault.generator import get_factory_group
+from asfault.network import SEG_FACTORIES, generate_factories
+from asfault.sampling import AliasTable, FactoryTable
+
+SAMPLES = 100000
+TOLERANCE = 0.01
+
+
+def get_frequencies(sample, count):
+    ret = [0] * count
+    for _ in range(SAMPLES):
+        ret[sample()] += 1
+    return [hits / SAMPLES for hits in ret]
+
+
+def test_alias_table_uniform():
+    rng = random.Random(1)
+    table = AliasTable([2.0] * 4)
+    freqs = get_frequencies(lambda: table.sample(rng), len(table))
+    assert freqs == pytest.approx([0.25] * 4, abs=TOLERANCE)
+
+
+def test_alias_table_weighted():
+    rng = random.Random(2)
+    weights = [1.0, 3.0, 0.5, 5.5, 0.0]
+    table = AliasTable(weights)
+    freqs = get_frequencies(lambda: table.sample(rng), len(table))
+    expected = [weight / sum(weights) for weight in weights]
+    assert freqs == pytest.approx(expected, abs=TOLERANCE)
+    assert freqs[-1] == 0
+
+
+def test_alias_table_rejects_empty_weights():
+    with pytest.raises(ValueError):
+        AliasTable([])
+    with pytest.raises(ValueError):
+        AliasTable([0.0, 0.0])
+
+
+def get_table():
+    keys = ['a1', 'a2', 'b1', 'b2', 'b3', 'c1']
+    weights = {'a1': 1.0, 'a2': 3.0, 'b1': 2.0, 'b3': 4.0, 'c1': 0.5}
+    return FactoryTable(keys, lambda key: key[0], weights), weights
+
+
+def get_key_frequencies(table, rng, mask):
+    index = {key: idx for idx, key in enumerate(table.keys)}
+    return get_frequencies(lambda: index[table.sample(rng, mask)],
+                           len(table.keys))
+
+
+def test_factory_table_weighted():
+    rng = random.Random(3)
+    table, weights = get_table()
+    freqs = get_key_frequencies(table, rng, table.full)
+    # Keys without a weight weigh 1
+    total = sum(weights.values()) + 1.0
+    expected = [weights.get(key, 1.0) / total for key in table.keys]
+    assert freqs == pytest.approx(expected, abs=TOLERANCE)
+
+
+def test_factory_table_masked():
+    rng = random.Random(4)
+    table, weights = get_table()
+    mask = table.remove_group(table.full, 'b2')
+    freqs = get_key_frequencies(table, rng, mask)
+    total = weights['a1'] + weights['a2'] + weights['c1']
+    expected = [weights[key] / total if key[0] != 'b' else 0.0
+                for key in table.keys]
+    assert freqs == pytest.approx(expected, abs=TOLERANCE)
+    assert not any(freq for key, freq in zip(table.keys, freqs)
+                   if key[0] == 'b')
+
+
+def test_factory_table_empty_mask():
+    table, _ = get_table()
+    mask = table.full
+    for key in ('a1', 'b1', 'c1'):
+        mask = table.remove_group(mask, key)
+    assert mask == 0
+    assert table.sample(random.Random(5), mask) is None
+
+
+def test_remove_group_matches_first_character_rule():
+    # Generators used to discard every factory whose key starts with the same
+    # character as the one that failed
+    generate_factories()
+    table = FactoryTable(SEG_FACTORIES, get_factory_group)
+    assert len(table.groups) == 3
+    for fac_key in SEG_FACTORIES:
+        mask = table.remove_group(table.full, fac_key)
+        left = {key for key in SEG_FACTORIES if mask & table.bits[key]}
+        expected = {key for key in SEG_FACTORIES if key[0] != fac_key[0]}
+        assert left == expected